@@ -40,6 +40,12 @@ def add_spam():
     return Spam().add()
 
 
+@app.route(ver + '/spams:batch', methods=['POST'])
+def add_spams_batch():
+    Validation().add_spams_batch()
+    return Spam().add_batch()
+
+
 # ---------------------------------------------
 # Error Routing
 # ---------------------------------------------
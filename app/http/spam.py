@@ -6,8 +6,10 @@ from app import app
 from app.http.response import Response
 from app.redis.connect import Connect
 from app.mysql.message_spams import MessageSpams
+from app.ml.cache import PredictCache
 from app.ml.predict import Predict
 from app.ml.wakati import Wakati
+from app.utility.executor import Executor
 
 
 class Spam():
@@ -16,6 +18,24 @@ class Spam():
     ものとする。なので、当クラス内でパラメータチェックは行わない。
     '''
 
+    def _predict(self):
+        return Predict(
+            model=app.config['MODEL_MSG_MLM'],
+            version=app.config['MODEL_MSG_MLM_VERSION'])
+
+    def _parse_predict(self, pr, bundle, bodies):
+        '''
+        分かち書きとpredictはCPUを使うので、Executorで実行する
+        @param Predict pr
+        @param Bundle bundle
+        @param list of str bodies 分かち書き前の文字列
+        @return list of dict
+        '''
+        wakati = Wakati()
+        return pr._predict_many(
+            [wakati.tokens(body) for body in bodies], bundle=bundle,
+            tokens=True)
+
     def add(self):
         '''
 
@@ -23,14 +43,11 @@ class Spam():
 
         data = request.get_json()
 
-        pr = Predict(
-            vect=app.config['PICKLE_MSG_MLM_TFIDF'],
-            lsa=app.config['PICKLE_MSG_MLM_LSA'],
-            clf=app.config['PICKLE_MSG_MLM_CLF'])
-
-        body = Wakati().parse(data['body'])
-
-        res = pr._predict(body)
+        # 同じ本文であればキャッシュした結果を返す
+        res = PredictCache(
+            model=app.config['MODEL_MSG_MLM'],
+            version=app.config['MODEL_MSG_MLM_VERSION']
+        ).run(data['body'])
 
         items = {
             'spam': {
@@ -40,3 +57,37 @@ class Spam():
         }
 
         return Response().parse(items)
+
+    def add_batch(self):
+        '''
+        複数のbodyをまとめてpredictする
+        分かち書きは1件ずつ行うが、TF-IDF, LSA, clfは1回ずつしか実行しない
+        こういうデータが渡されることを想定
+        { "items": [{"id": "xxx", "body": "xxx"},...] }
+        '''
+
+        data = request.get_json()
+
+        pr = self._predict()
+        bundle = pr.get_model()
+
+        res = Executor().run(
+            self._parse_predict,
+            pr,
+            bundle,
+            [item['body'] for item in data['items']])
+
+        spams = []
+        for i, item in enumerate(data['items']):
+            spams.append({
+                'id': item['id'],
+                'probability': res[i]['score'],
+                'predict': res[i]['predict'],
+                'vocabulary': res[i]['vocabulary'],
+            })
+
+        items = {
+            'spams': spams
+        }
+
+        return Response().parse(items)
@@ -2,6 +2,8 @@
 
 from flask import request, abort
 
+from app import app
+
 
 class Validation():
     '''
@@ -68,6 +70,68 @@ class Validation():
                 'errors': errors
             })
 
+    def add_spams_batch(self):
+        '''
+        こういうデータが渡されることを想定
+        { "items": [{"id": "xxx", "body": "xxx"},...] }
+        itemsの数はSPAM_BATCH_MAX_SIZE以下であること
+        '''
+
+        errors = []
+
+        # Body param の存在チェック
+        if not request.data:
+            errors.append({
+                'field': 'body parameter',
+                'code': 'missing'
+            })
+
+        else:
+            # get_jsonはbodyデータをdictに変換する
+            data = request.get_json()
+
+            if 'items' not in data:
+                errors.append({
+                    'field': 'items',
+                    'code': 'missing'
+                })
+            elif not isinstance(data['items'], list) or not data['items']:
+                errors.append({
+                    'field': 'items',
+                    'code': 'invalid'
+                })
+            elif len(data['items']) > app.config['SPAM_BATCH_MAX_SIZE']:
+                errors.append({
+                    'field': 'items',
+                    'code': 'too_many'
+                })
+            else:
+                for i, item in enumerate(data['items']):
+                    if not isinstance(item, dict) or 'id' not in item:
+                        errors.append({
+                            'field': 'items[{0}].id'.format(i),
+                            'code': 'missing'
+                        })
+                        continue
+
+                    if 'body' not in item:
+                        errors.append({
+                            'field': 'items[{0}].body'.format(i),
+                            'code': 'missing'
+                        })
+                    elif not isinstance(item['body'], str):
+                        errors.append({
+                            'field': 'items[{0}].body'.format(i),
+                            'code': 'invalid'
+                        })
+
+        if errors:
+            abort(400, {
+                'code': 'invalid_parameter',
+                'message': 'Validation Failed',
+                'errors': errors
+            })
+
     def list_messages(self):
         ''''''
 
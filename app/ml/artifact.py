@@ -0,0 +1,226 @@
+# coding: utf-8
+
+import io
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+from app import app
+
+
+class Artifact():
+    '''
+    学習済みモデルをsklearnのpickleではなく、numpyの配列だけで保存する形式
+    pickleだとunpickleの度にsklearnのオブジェクトを丸ごと組み立て直すことになり、
+    sklearnのバージョンを上げるとpickleの互換性も気にしなければならない。
+    配列は.npy形式で保存するので、ローカルのファイルキャッシュからは
+    numpy.load(mmap_mode='r')で読み込むことができ、Redisにはそのままbytesで保存できる
+
+    Redisにはhash型で、次のように保存する
+    {
+        'manifest': b'{"format": 1, "params": {...}, "arrays": {...}, ...}',
+        'terms': b'\\x93NUMPY...',
+        'index': b'\\x93NUMPY...',
+        ...
+    }
+    '''
+
+    FORMAT = 1
+
+    # terms: ソート済みの単語, index: termsのそれぞれがTF-IDFの何列目か
+    # idf, components(LSA)はfloat32で保持する
+    ARRAYS = (
+        'terms', 'index', 'idf', 'components', 'coef', 'intercept',
+        'classes', 'fused_coef', 'fused_intercept',
+    )
+
+    # TfidfVectorizerのうち、Bundle.transformが再現しているパラメータ
+    PARAMS = {
+        'analyzer': 'word',
+        'lowercase': True,
+        'token_pattern': r'(?u)\b\w\w+\b',
+        'ngram_range': [1, 1],
+        'norm': 'l2',
+        'use_idf': True,
+        'sublinear_tf': False,
+    }
+
+    def __init__(self, directory=None):
+        '''
+        @param str directory ローカルのファイルキャッシュの場所
+        '''
+        if directory:
+            self.directory = directory
+        else:
+            self.directory = app.config['MODEL_CACHE_DIR']
+
+    def build(self, vect, lsa, clf):
+        '''
+        学習済みのsklearnオブジェクトから配列を取り出す
+        @param TfidfVectorizer vect
+        @param TruncatedSVD lsa
+        @param PassiveAggressiveClassifier clf
+        @return dict {name: ndarray}
+        '''
+        params = vect.get_params()
+        for key, val in self.PARAMS.items():
+            if key == 'ngram_range':
+                val = tuple(val)
+            if params[key] != val:
+                raise Exception(
+                    'TfidfVectorizer param {0}={1} is not supported'.format(
+                        key, params[key]))
+
+        terms = sorted(vect.vocabulary_)
+
+        arrays = {
+            'terms': np.array(terms),
+            'index': np.array(
+                [vect.vocabulary_[term] for term in terms], dtype=np.int32),
+            'idf': vect.idf_.astype(np.float32),
+            'components': lsa.components_.astype(np.float32),
+            'coef': clf.coef_.ravel().astype(np.float64),
+            'intercept': np.asarray(clf.intercept_, dtype=np.float64),
+            'classes': np.asarray(clf.classes_, dtype=np.int64),
+        }
+
+        # LSAもclfのdecision_functionも線形なので、1本の重みベクトルにまとめられる
+        # 実際にpredictで使うfloat32のcomponentsからまとめる
+        arrays['fused_coef'] = arrays['components'].T.astype(
+            np.float64).dot(arrays['coef'])
+        arrays['fused_intercept'] = arrays['intercept'].copy()
+
+        return arrays
+
+    def _digest(self, b):
+        return hashlib.sha256(b).hexdigest()
+
+    def dumps(self, arrays):
+        '''
+        Redisのhashに保存できる形式に変換する
+        @param dict arrays {name: ndarray}
+        @return dict {name: bytes}
+        '''
+        fields = {}
+        digests = {}
+
+        for name in self.ARRAYS:
+            buf = io.BytesIO()
+            np.save(buf, arrays[name], allow_pickle=False)
+            fields[name] = buf.getvalue()
+            digests[name] = self._digest(fields[name])
+
+        manifest = {
+            'format': self.FORMAT,
+            'params': self.PARAMS,
+            'arrays': digests,
+            'checksum': self._digest(
+                json.dumps(digests, sort_keys=True).encode('utf-8')),
+        }
+
+        fields['manifest'] = json.dumps(manifest, sort_keys=True).encode(
+            'utf-8')
+
+        return fields
+
+    def manifest(self, b):
+        '''
+        @param bytes b
+        @return dict
+        '''
+        manifest = json.loads(b.decode('utf-8'))
+
+        if manifest['format'] != self.FORMAT:
+            raise Exception('Unsupported model format: {0}'.format(
+                manifest['format']))
+
+        return manifest
+
+    def _path(self, manifest):
+        # 中身のchecksumをディレクトリ名にしているので、同じ名前であれば中身も同じ
+        return os.path.join(self.directory, manifest['checksum'])
+
+    def read(self, manifest):
+        '''
+        ローカルのファイルキャッシュからmmapで読み込む
+        @param dict manifest
+        @return dict {name: ndarray} | None キャッシュがなければNone
+        '''
+        path = self._path(manifest)
+        if not os.path.isdir(path):
+            return None
+
+        return {
+            name: np.load(
+                os.path.join(path, name + '.npy'),
+                mmap_mode='r',
+                allow_pickle=False)
+            for name in self.ARRAYS
+        }
+
+    def _verify(self, fields):
+        '''
+        @param dict fields {name: bytes}
+        @return dict manifest
+        '''
+        manifest = self.manifest(fields['manifest'])
+
+        for name in self.ARRAYS:
+            if self._digest(fields[name]) != manifest['arrays'][name]:
+                raise Exception('Model checksum mismatch: {0}'.format(name))
+
+        return manifest
+
+    def loads(self, fields):
+        '''
+        bytesを検証し、メモリ上に展開する
+        @param dict fields {name: bytes}
+        @return dict manifest, dict {name: ndarray}
+        '''
+        manifest = self._verify(fields)
+
+        arrays = {
+            name: np.load(io.BytesIO(fields[name]), allow_pickle=False)
+            for name in self.ARRAYS
+        }
+
+        return manifest, arrays
+
+    def write(self, fields):
+        '''
+        Redisから取得したbytesを検証し、ローカルのファイルキャッシュに書き出す
+        書き出せない場合はメモリ上に展開したものを返す
+        @param dict fields {name: bytes}
+        @return dict manifest, dict {name: ndarray}
+        '''
+        manifest = self._verify(fields)
+
+        path = self._path(manifest)
+        # 一時ディレクトリに書いてからrenameするので、他のプロセスが
+        # 書きかけのファイルを読み込むことはない
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+
+        try:
+            os.makedirs(tmp, exist_ok=True)
+            for name in self.ARRAYS:
+                with open(os.path.join(tmp, name + '.npy'), 'wb') as f:
+                    f.write(fields[name])
+
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # 他のプロセスが先に書き出していれば、そちらを使う
+                shutil.rmtree(tmp, ignore_errors=True)
+
+            arrays = self.read(manifest)
+            if arrays is None:
+                return self.loads(fields)
+        except OSError as e:
+            app.logger.warning(
+                'Model cache write is failed. Reason: {0}'.format(e))
+            shutil.rmtree(tmp, ignore_errors=True)
+            return self.loads(fields)
+
+        return manifest, arrays
@@ -0,0 +1,169 @@
+# coding: utf-8
+
+import os
+import threading
+import time
+
+from app import app
+from app.ml.predict import Predict
+from app.utility.executor import Executor
+from app.utility.metrics import Metrics
+
+
+class _Slot():
+    '''
+    Batcherに渡された1件分の対象と、その結果
+    '''
+
+    def __init__(self, body):
+        self.body = body
+        self.enqueued = time.monotonic()
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Batcher():
+    '''
+    同時に呼び出されたpredictをまとめて、1回の_predict_manyで実行する
+    1件ずつpredictするとTF-IDF, clfの呼び出し自体のオーバーヘッドが大半を占めるので、
+    最大PREDICT_BATCH_SIZE件、最初の1件からPREDICT_BATCH_WAIT_MSミリ秒までの
+    呼び出しをまとめる。呼び出し元は自分の結果が出るまで待つ
+
+    まとめて実行するのはプロセスごとに1つのスレッド(geventの場合はgreenlet)で、
+    predict自体はExecutorで実行する
+
+    Metrics('batcher')に次の値を記録する
+    - fill_ratio: 1回に実行した件数 / PREDICT_BATCH_SIZE
+    - queue_delay_ms: 呼び出されてから実行が始まるまでの待ち時間
+    '''
+
+    # key: (pid, model, version), value: Batcher
+    _batchers = {}
+    _lock = threading.Lock()
+    # Trueの場合はgeventでなくてもまとめる。複数のスレッドからpredictする場合に使う
+    _enabled = False
+
+    def __init__(self, model=None, version=None):
+        '''
+        直接インスタンスを作らず、Batcher.get()を使うこと
+        @param str model
+        @param str version
+        '''
+        self.predict = Predict(model=model, version=version)
+        self.size = app.config['PREDICT_BATCH_SIZE']
+        self.wait = app.config['PREDICT_BATCH_WAIT_MS'] / 1000
+        self.metrics = Metrics('batcher')
+
+        self._pending = []
+        self._cond = threading.Condition()
+
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @classmethod
+    def enable(cls):
+        '''
+        geventのworkerでなくても、同時に呼び出されたpredictをまとめるようにする
+        '''
+        cls._enabled = True
+
+    @classmethod
+    def is_enabled(cls):
+        '''
+        1件ずつしか呼び出されない場合は待つだけ無駄なので、
+        geventのworkerか、enableを呼び出した場合だけまとめる
+        @return bool
+        '''
+        return cls._enabled or Executor.cooperative()
+
+    @classmethod
+    def get(cls, model=None, version=None):
+        '''
+        プロセス内で共有するBatcherを返す
+        @param str model
+        @param str version
+        @return Batcher
+        '''
+        # forkしたworkerにmasterのスレッドは引き継がれないので、プロセスごとに作る
+        key = (os.getpid(), model, version)
+
+        with cls._lock:
+            if key not in cls._batchers:
+                cls._batchers[key] = cls(model=model, version=version)
+
+        return cls._batchers[key]
+
+    def run(self, body):
+        '''
+        1件をpredictする。他の呼び出しとまとめて実行されるまで待つ
+        @param str body 分かち書き済みの文字列
+        @return dict Predict._predictと同じ
+        '''
+        # まとめる必要がなければそのまま実行する
+        if self.size <= 1:
+            return self.predict._predict(body)
+
+        slot = _Slot(body)
+
+        with self._cond:
+            self._pending.append(slot)
+            self._cond.notify()
+
+        slot.event.wait()
+
+        if slot.error is not None:
+            raise slot.error
+
+        return slot.result
+
+    def _take(self):
+        '''
+        最大size件、または最初の1件からwait秒経つまで待ってから取り出す
+        @return list of _Slot
+        '''
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+
+            deadline = self._pending[0].enqueued + self.wait
+            while len(self._pending) < self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            slots = self._pending[:self.size]
+            del self._pending[:self.size]
+
+        return slots
+
+    def _loop(self):
+        while True:
+            slots = self._take()
+
+            started = time.monotonic()
+            for slot in slots:
+                self.metrics.observe(
+                    'queue_delay_ms', (started - slot.enqueued) * 1000)
+            self.metrics.observe('fill_ratio', len(slots) / self.size)
+            self.metrics.incr('batches')
+
+            try:
+                # モデルの取得(Redisへの通信)はExecutorの外で行う
+                bundle = self.predict.get_model()
+                results = Executor().run(
+                    self.predict._predict_many,
+                    [slot.body for slot in slots],
+                    bundle)
+                for slot, result in zip(slots, results):
+                    slot.result = result
+            except Exception as e:
+                app.logger.error(
+                    'Batch predict is failed. Reason: {0}'.format(e))
+                for slot in slots:
+                    slot.error = e
+
+            for slot in slots:
+                slot.event.set()
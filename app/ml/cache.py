@@ -0,0 +1,181 @@
+# coding: utf-8
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from app import app
+from app.ml.predict import Predict
+from app.ml.wakati import Wakati
+from app.redis.connect import Connect
+from app.utility.executor import Executor
+from app.utility.metrics import Metrics
+
+
+class _Call():
+    '''
+    実行中のpredict。同じ本文の呼び出しはこの結果を待つ
+    '''
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class PredictCache():
+    '''
+    predictの結果をキャッシュする
+    MLMのspamは同じ本文が大量に送られてくるので、正規化した本文が同じであれば
+    分かち書き, TF-IDF, clfを実行せずに前回の結果を返す
+
+    - 1段目: プロセス内のLRU。最大PREDICT_CACHE_SIZE件
+    - 2段目: Redis。PREDICT_CACHE_TTL秒で消える。worker, サーバ間で共有する
+    - 同じ本文の呼び出しが同時にあった場合は、最初の1件だけpredictし、
+      残りはその結果を待つ
+
+    キーは正規化した本文のsha1とモデルのchecksumから作るので、
+    新しいモデルに差し替わると古い結果は使われなくなる
+
+    Metrics('predict_cache')に次の値を記録する
+    hit_local, hit_redis, miss, coalesced, eviction
+    '''
+
+    # key: (model, checksum, digest), value: dict
+    _lru = OrderedDict()
+    # key: model, value: LRUに入っている結果を作ったモデルのchecksum
+    _checksums = {}
+    # key: (model, checksum, digest), value: _Call
+    _calls = {}
+    _lock = threading.Lock()
+
+    def __init__(self, model=None, version=None):
+        '''
+        @param str model
+        @param str version
+        '''
+        self.model = model
+        self.predict = Predict(model=model, version=version)
+        self.metrics = Metrics('predict_cache')
+
+    def _digest(self, normalized):
+        return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+    def _get_local(self, key):
+        with self._lock:
+            # モデルが差し替わっていれば、古いモデルの結果を全て捨てる
+            if self._checksums.get(self.model) != key[1]:
+                for k in [k for k in self._lru if k[0] == self.model]:
+                    del PredictCache._lru[k]
+                PredictCache._checksums[self.model] = key[1]
+
+            item = self._lru.get(key)
+            if item is not None:
+                self._lru.move_to_end(key)
+
+        return item
+
+    def _set_local(self, key, item):
+        evicted = 0
+
+        with self._lock:
+            if self._checksums.get(self.model) != key[1]:
+                return
+
+            PredictCache._lru[key] = item
+            self._lru.move_to_end(key)
+            while len(self._lru) > app.config['PREDICT_CACHE_SIZE']:
+                self._lru.popitem(last=False)
+                evicted += 1
+
+        if evicted:
+            self.metrics.incr('eviction', evicted)
+
+    def _redis_key(self, key):
+        return app.config['PREDICT_CACHE'].format(*key)
+
+    def _get_redis(self, key):
+        try:
+            item = Connect(role='slave').open().get(self._redis_key(key))
+        except Exception as e:
+            # キャッシュが使えなくてもpredictはできるので、失敗させない
+            app.logger.warning(
+                'Predict cache get is failed. Reason: {0}'.format(e))
+            return None
+
+        return json.loads(item) if item else None
+
+    def _set_redis(self, key, item):
+        try:
+            Connect().open().setex(
+                self._redis_key(key),
+                app.config['PREDICT_CACHE_TTL'],
+                json.dumps(item))
+        except Exception as e:
+            app.logger.warning(
+                'Predict cache set is failed. Reason: {0}'.format(e))
+
+    def _load(self, key, normalized):
+        '''
+        Redis, predictの順に結果を取得する
+        @return dict
+        '''
+        item = self._get_redis(key)
+        if item is not None:
+            self.metrics.incr('hit_redis')
+            return item
+
+        self.metrics.incr('miss')
+
+        body = Executor().run(Wakati().parse, normalized, normalized=True)
+        item = self.predict._predict_batched(body)
+
+        self._set_redis(key, item)
+
+        return item
+
+    def run(self, doc):
+        '''
+        分かち書き前の本文をpredictする
+        @param str doc
+        @return dict Predict._predictと同じ
+        '''
+        normalized = Executor().run(Wakati().normalize, doc)
+
+        bundle = self.predict.get_model()
+        key = (self.model, bundle.manifest['checksum'],
+               self._digest(normalized))
+
+        item = self._get_local(key)
+        if item is not None:
+            self.metrics.incr('hit_local')
+            return item
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                PredictCache._calls[key] = call
+
+        if not leader:
+            # 同じ本文を他の呼び出しがpredictしているので、その結果を待つ
+            self.metrics.incr('coalesced')
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._load(key, normalized)
+            self._set_local(key, call.result)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del PredictCache._calls[key]
+            call.event.set()
+
+        return call.result
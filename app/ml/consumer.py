@@ -0,0 +1,170 @@
+# coding: utf-8
+
+import signal
+import socket
+import threading
+import time
+
+from app import app
+from app.ml.batcher import Batcher
+from app.ml.pipeline import Pipeline
+from app.ml.predict import Predict
+from app.redis.connect import Connect
+from app.redis.scripts import Scripts
+from app.utility.metrics import Metrics
+
+
+class Consumer():
+    '''
+    QUEUE_BASE_MSGからmessage_idを取り出し続けてspamかどうかを予測する常駐プロセス
+    Predict.runは1回の起動で1件しか処理しないので、こちらを使うこと
+
+    取り出したmessage_idは、処理が終わるまで自分用の処理中リストに入れておく。
+    プロセスが落ちても処理中リストに残るので、次に起動したときにキューに戻す
+    - 1回の通信で最大CONSUMER_BATCH_SIZE件を処理中リストに移す
+    - キューが空であればBRPOPLPUSHで待つ
+    - Predict.stages_msgの段階ごとにPipelineで並行に処理する
+      段階ごとのスレッド数はPIPELINE_CONCURRENCYで指定する
+    - 成功したら処理中リストから消す。失敗したら処理中リストから消してキューの末尾に戻す
+    - SIGTERM, SIGINTを受け取ったら、取り出し済みの分を処理してから終了する
+    '''
+
+    def __init__(self, name=None):
+        '''
+        @param str name 処理中リストの名前
+            再起動しても同じ処理中リストを使うように、プロセスごとに固定の値を渡すこと
+            Noneの場合はホスト名
+        '''
+        self.name = name if name else socket.gethostname()
+        self.queue = app.config['QUEUE_BASE_MSG']
+        self.processing = app.config['QUEUE_PROCESSING_MSG'].format(self.name)
+        self.predict = Predict(
+            model=app.config['MODEL_MSG_MLM'],
+            version=app.config['MODEL_MSG_MLM_VERSION'])
+        self.metrics = Metrics('consumer')
+        self.r = Connect().open()
+        self._take = self.r.register_script(Scripts.TAKE)
+        self._stopped = False
+
+        self._lock = threading.Lock()
+        self._processed = 0
+        self._failed = 0
+
+    def stop(self, signum=None, frame=None):
+        '''
+        取り出し済みの分を処理し終えたら終了する
+        '''
+        app.logger.info('Consumer is stopping. name: {0}'.format(self.name))
+        self._stopped = True
+
+    def recover(self):
+        '''
+        前回落ちたときに処理中リストに残ったmessage_idをキューの先頭に戻す
+        処理中リストの末尾から順にキューの先頭に移すので、順番は変わらない
+        @return int 戻した件数
+        '''
+        count = 0
+        while self.r.rpoplpush(self.processing, self.queue):
+            count += 1
+
+        if count:
+            app.logger.warning(
+                'Consumer recovered {0} messages. name: {1}'.format(
+                    count, self.name))
+
+        return count
+
+    def _fetch(self):
+        '''
+        @return list of str message_id
+        '''
+        ids = self._take(
+            keys=[self.queue, self.processing],
+            args=[app.config['CONSUMER_BATCH_SIZE']])
+
+        if ids:
+            return ids
+
+        # キューが空の時だけ待つ。空のキューに入った1件目は末尾でもあり先頭でもあるので、
+        # 末尾から取り出すBRPOPLPUSHでも順番は変わらない
+        msg_id = self.r.brpoplpush(
+            self.queue,
+            self.processing,
+            timeout=app.config['CONSUMER_BLOCK_TIMEOUT'])
+
+        return [msg_id] if msg_id else []
+
+    def _done(self, msg_id, error):
+        '''
+        Pipelineで1件の処理が終わった時に呼ばれる
+        @param str msg_id
+        @param Exception error 成功した場合はNone
+        '''
+        if error is None:
+            self.r.lrem(self.processing, 1, msg_id)
+            with self._lock:
+                self._processed += 1
+            return
+
+        app.sentry.captureException(str(error))
+        app.logger.error(
+            'predict message is failed. Reason: {0}'.format(error))
+        # 失敗した場合はキューに戻す
+        with self.r.pipeline() as pipe:
+            pipe.lrem(self.processing, 1, msg_id)
+            pipe.rpush(self.queue, msg_id)
+            pipe.execute()
+
+        with self._lock:
+            self._failed += 1
+
+    def _report(self, elapsed):
+        with self._lock:
+            processed, failed = self._processed, self._failed
+            self._processed = 0
+            self._failed = 0
+
+        lag = self.r.llen(self.queue)
+
+        self.metrics.incr('processed', processed)
+        self.metrics.incr('failed', failed)
+        self.metrics.observe('lag', lag)
+
+        app.logger.info(
+            'Consumer name: {0} throughput: {1:.1f} msg/s failed: {2} lag: {3}'.format(
+                self.name, processed / elapsed, failed, lag))
+
+    def run(self):
+        '''
+        SIGTERMを受け取るまで処理し続ける
+        '''
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self.recover()
+
+        if app.config['PIPELINE_CONCURRENCY']['predict'] > 1:
+            # 複数のスレッドからのpredictをまとめて実行する
+            Batcher.enable()
+
+        pipeline = Pipeline(self.predict.stages_msg(), self._done)
+
+        reported = time.monotonic()
+
+        app.logger.info('Consumer is started. name: {0}'.format(self.name))
+
+        try:
+            while not self._stopped:
+                # Pipelineが詰まっていればsubmitが待つので、取り出しすぎることはない
+                for msg_id in self._fetch():
+                    pipeline.submit(msg_id, int(msg_id))
+
+                elapsed = time.monotonic() - reported
+                if elapsed >= app.config['CONSUMER_REPORT_INTERVAL']:
+                    self._report(elapsed)
+                    reported = time.monotonic()
+        finally:
+            pipeline.close()
+            self.metrics.flush(force=True)
+
+        app.logger.info('Consumer is stopped. name: {0}'.format(self.name))
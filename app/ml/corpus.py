@@ -0,0 +1,45 @@
+# coding: utf-8
+
+import ctypes
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+
+class SharedCorpus():
+    '''
+    文字列のlistを、forkしたworkerから読み込み専用で参照するための構造
+    UTF-8でつなげたbufferと、i番目の文字列の開始位置offsets[i]を共有メモリに置く
+
+    listのままforkで引き継ぐと、参照するだけでrefcountが書き換わり、
+    workerごとにページがコピーされる。bufferはPythonのobjectではないのでコピーされない
+    Poolを作る前に作っておくこと。forkの後に作ったものはworkerからは見えない
+    '''
+
+    def __init__(self, texts):
+        '''
+        @param list of string texts
+        '''
+        encoded = [text.encode('utf-8') for text in texts]
+        lengths = np.fromiter(
+            (len(e) for e in encoded), dtype=np.int64, count=len(encoded))
+
+        self.offsets = RawArray(ctypes.c_int64, len(encoded) + 1)
+        offsets = np.frombuffer(self.offsets, dtype=np.int64)
+        offsets[0] = 0
+        np.cumsum(lengths, out=offsets[1:])
+
+        # 長さ0のRawArrayは作れないので、最低1byteにする
+        size = int(offsets[-1])
+        self.buffer = RawArray(ctypes.c_char, max(size, 1))
+        ctypes.memmove(self.buffer, b''.join(encoded), size)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        '''
+        @param int i
+        @return string
+        '''
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
@@ -0,0 +1,119 @@
+# coding: utf-8
+
+import hashlib
+import zlib
+
+import numpy as np
+
+from app import app
+
+
+class MinHash():
+    '''
+    分かち書きの文字列をshingle(連続するOVERLAP_SHINGLE_SIZE文字)の集合にし、
+    MinHashのsignatureを作る。
+    2つのsignatureが一致する割合は、shingleの集合のJaccard係数の推定値になる
+
+    signatureをOVERLAP_LSH_BANDS個のbandに分け、bandごとのハッシュをbucketにする。
+    似ているものは少なくとも1つのbandでbucketが一致するので、全件と比較せずに
+    候補を絞り込める。Jaccard係数がsの2つが候補になる確率は
+        1 - (1 - s ** OVERLAP_LSH_ROWS) ** OVERLAP_LSH_BANDS
+    になる。BANDSを増やす・ROWSを減らすと取りこぼしが減り、候補が増える
+    '''
+
+    # 32bitのハッシュより大きい素数。(a * x + b) % PRIMEがuint64に収まる
+    PRIME = 4294967311
+
+    def __init__(self, shingle_size=None, bands=None, rows=None, seed=1):
+        '''
+        signatureを保存して比較する場合は、同じ引数で作ったMinHashを使うこと
+        @param int shingle_size 省略した場合はOVERLAP_SHINGLE_SIZE
+        @param int bands 省略した場合はOVERLAP_LSH_BANDS
+        @param int rows 省略した場合はOVERLAP_LSH_ROWS
+        @param int seed ハッシュ関数を作るための乱数のseed
+        '''
+        self.shingle_size = shingle_size or app.config['OVERLAP_SHINGLE_SIZE']
+        self.bands = bands or app.config['OVERLAP_LSH_BANDS']
+        self.rows = rows or app.config['OVERLAP_LSH_ROWS']
+
+        num_perm = self.bands * self.rows
+        rs = np.random.RandomState(seed)
+        self.a = rs.randint(1, 2 ** 32, size=num_perm).astype(np.uint64)
+        self.b = rs.randint(0, 2 ** 32, size=num_perm).astype(np.uint64)
+
+    def shingles(self, text):
+        '''
+        @param string text
+        @return set of string
+        '''
+        k = self.shingle_size
+        if len(text) <= k:
+            return {text} if text else set()
+
+        return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+    def signature(self, text):
+        '''
+        @param string text 分かち書きの文字列
+        @return ndarray uint64 長さはbands * rows
+        '''
+        shingles = self.shingles(text)
+        if not shingles:
+            # 空文字どうしは一致させる
+            return np.full(len(self.a), self.PRIME, dtype=np.uint64)
+
+        hv = np.fromiter(
+            (zlib.crc32(s.encode('utf-8')) for s in shingles),
+            dtype=np.uint64, count=len(shingles))
+
+        return ((np.outer(hv, self.a) + self.b) % self.PRIME).min(axis=0)
+
+    def buckets(self, signature):
+        '''
+        bandごとのbucketのキー
+        @param ndarray signature
+        @return list of string i番目がi番目のbandのbucket
+        '''
+        rows = self.rows
+        return [
+            hashlib.md5(signature[i * rows:(i + 1) * rows].tobytes())
+            .hexdigest()[:16]
+            for i in range(self.bands)]
+
+
+class LSH():
+    '''
+    MinHashのbucketでの、プロセス内の近似重複のindex
+    candidatesは候補を返すだけなので、実際に重複しているかは呼び出し側で確認すること
+    '''
+
+    def __init__(self, minhash=None):
+        '''
+        @param MinHash minhash
+        '''
+        self.minhash = minhash or MinHash()
+        # bandごとに、key: bucket, value: list of id
+        self.tables = [{} for _ in range(self.minhash.bands)]
+
+    def add(self, obj_id, text):
+        '''
+        @param string obj_id
+        @param string text
+        '''
+        buckets = self.minhash.buckets(self.minhash.signature(text))
+        for table, bucket in zip(self.tables, buckets):
+            table.setdefault(bucket, []).append(obj_id)
+
+    def candidates(self, text):
+        '''
+        いずれかのbandでbucketが一致するid
+        @param string text
+        @return set of string
+        '''
+        buckets = self.minhash.buckets(self.minhash.signature(text))
+
+        found = set()
+        for table, bucket in zip(self.tables, buckets):
+            found.update(table.get(bucket, ()))
+
+        return found
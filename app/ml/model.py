@@ -0,0 +1,282 @@
+# coding: utf-8
+
+import re
+import threading
+import time
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from app import app
+from app.ml.artifact import Artifact
+from app.redis.connect import Connect
+
+
+class Bundle():
+    '''
+    1回の学習(Train.run)で作成されたモデル
+    配列をまとめて1つのオブジェクトとして差し替えるので、読み取り側が異なる学習の
+    tfidfとclfを混ぜて使うことはない
+    sklearnのオブジェクトは持たず、Artifactの配列だけでpredictする
+    '''
+
+    def __init__(self, version, manifest, arrays):
+        '''
+        @param int version
+        @param dict manifest
+        @param dict arrays {name: ndarray}
+        '''
+        self.version = version
+        self.manifest = manifest
+
+        self.terms = arrays['terms']
+        self.index = arrays['index']
+        self.idf = arrays['idf']
+        self.components = arrays['components']
+        self.coef = arrays['coef']
+        self.intercept = float(arrays['intercept'][0])
+        self.classes = arrays['classes']
+        self.fused_coef = arrays['fused_coef']
+        self.fused_intercept = float(arrays['fused_intercept'][0])
+
+        self.token_pattern = re.compile(manifest['params']['token_pattern'])
+        # 列番号から単語を引くための配列
+        self.vocabulary = self.terms[np.argsort(self.index)]
+
+    def transform(self, bodies):
+        '''
+        TfidfVectorizer.transformと同じ値を返す
+        小文字にしてtoken_patternで単語に分け、ソート済みのtermsを二分探索して
+        列番号を求め、tf * idfをl2正規化する
+        @param list of str bodies 分かち書き済みの文字列
+        @return csr_matrix
+        '''
+        return self._tfidf(
+            [self.token_pattern.findall(body.lower()) for body in bodies])
+
+    def transform_tokens(self, tokens_list):
+        '''
+        Wakati.tokensの結果から、transformと同じ値を返す
+        空白でつなげてから分け直す代わりに、1語ずつtoken_patternを適用する。
+        token_patternは空白をまたがないので、結果は同じになる
+        @param list of list tokens_list
+        @return csr_matrix
+        '''
+        findall = self.token_pattern.findall
+
+        return self._tfidf([
+            [t for token in tokens for t in findall(token.lower())]
+            for tokens in tokens_list])
+
+    def _tfidf(self, tokens_list):
+        '''
+        @param list of list tokens_list token_patternで分けた単語
+        @return csr_matrix
+        '''
+        indptr = [0]
+        indices = []
+        data = []
+
+        for tokens in tokens_list:
+            if tokens:
+                tokens = np.array(tokens)
+                pos = np.searchsorted(self.terms, tokens)
+                # termsの末尾より後ろに来るものは存在しない単語
+                pos[pos >= len(self.terms)] = 0
+                hit = self.terms[pos] == tokens
+
+                cols, counts = np.unique(
+                    self.index[pos[hit]], return_counts=True)
+                vals = counts * self.idf[cols].astype(np.float64)
+
+                norm = np.sqrt(np.dot(vals, vals))
+                if norm > 0:
+                    vals = vals / norm
+
+                indices.extend(cols.tolist())
+                data.extend(vals.tolist())
+
+            indptr.append(len(indices))
+
+        return csr_matrix(
+            (data, indices, indptr),
+            shape=(len(tokens_list), len(self.terms)),
+            dtype=np.float64)
+
+    def decision_function(self, tfidf, fused=True):
+        '''
+        @param csr_matrix tfidf
+        @param bool fused
+            Trueであればfusedの重みベクトルとの内積1回でscoreを出す
+            Falseであればlsa >> clfの順に計算する
+        @return ndarray
+        '''
+        if fused:
+            return tfidf.dot(self.fused_coef) + self.fused_intercept
+
+        lsa = tfidf.dot(self.components.T)
+        return lsa.dot(self.coef) + self.intercept
+
+    def predict(self, scores):
+        '''
+        PassiveAggressiveClassifier.predictと同じく、scoreが0より大きければclasses[1]
+        @param ndarray scores
+        @return ndarray
+        '''
+        return self.classes[(scores > 0).astype(int)]
+
+
+class Model():
+    '''
+    Predict._predictで使うモデルをプロセス内にキャッシュする
+    リクエストの度にRedisからモデルを取得して組み立てると、それだけで
+    レイテンシとCPUの大半を使ってしまうので、1プロセスにつき1度だけ読み込む。
+    バージョンキーはTrain.runが学習の度にincrするので、MODEL_CHECK_INTERVAL秒に
+    1回だけバージョンキーを確認し、変わっていれば読み込み直して差し替える
+    配列はローカルのファイルキャッシュからmmapで読み込むので、同じサーバの
+    プロセス同士でメモリを共有できる
+    '''
+
+    # key: モデルのキー, value: Bundle
+    _bundles = {}
+    # key: モデルのキー, value: 最後にバージョンを確認した時刻
+    _checked = {}
+    _lock = threading.Lock()
+
+    def __init__(self, model=None, version=None):
+        '''
+        @param str model モデルが保存されているhashのキー
+        @param str version バージョンキー
+            Noneの場合はバージョンを確認せず、最初に読み込んだモデルを使い続ける
+        '''
+        self.key = model
+        self.version = version
+
+    def _get_version(self):
+        '''
+        @return int | None
+        '''
+        if not self.version:
+            return None
+
+        version = Connect(role='slave').open().get(self.version)
+        return int(version) if version else None
+
+    def _fetch(self, fields):
+        '''
+        hashとバージョンをMULTIでまとめて取得する
+        Train.runもMULTIで書き込んでいるので、異なる学習の配列が混ざることはない
+        @param bool fields Trueであれば全ての配列、Falseであればmanifestだけ取得する
+        @return tuple dict {name: bytes}, int version
+        '''
+        # decode_responses=Falseにしないと配列を取得できない
+        r = Connect(role='slave', decode_responses=False).open()
+
+        with r.pipeline(transaction=True) as pipe:
+            if fields:
+                pipe.hgetall(self.key)
+            else:
+                pipe.hget(self.key, 'manifest')
+            if self.version:
+                pipe.get(self.version)
+            res = pipe.execute()
+
+        if not res[0]:
+            raise Exception(
+                'Model is not found: {0}. Run ConvertModel or Train.run'.format(
+                    self.key))
+
+        if fields:
+            data = {key.decode('utf-8'): val for key, val in res[0].items()}
+        else:
+            data = {'manifest': res[0]}
+
+        version = res[-1] if self.version else None
+        version = int(version) if version else None
+
+        return data, version
+
+    def _load(self):
+        '''
+        ローカルのファイルキャッシュにあればmanifestだけを取得して読み込む。
+        なければ全ての配列を取得し、checksumを検証してからキャッシュに書き出す
+        @return Bundle
+        '''
+        artifact = Artifact()
+
+        data, version = self._fetch(fields=False)
+        manifest = artifact.manifest(data['manifest'])
+        arrays = artifact.read(manifest)
+
+        if arrays is None:
+            data, version = self._fetch(fields=True)
+            manifest, arrays = artifact.write(data)
+
+        return Bundle(version, manifest, arrays)
+
+    def _is_fresh(self, bundle, now):
+        return bundle is not None and \
+            now - self._checked.get(self.key, 0) < \
+            app.config['MODEL_CHECK_INTERVAL']
+
+    def get(self):
+        '''
+        キャッシュ済みのモデルを返す。必要であれば読み込み直す
+        @return Bundle
+        '''
+        bundle = self._bundles.get(self.key)
+        if self._is_fresh(bundle, time.monotonic()):
+            return bundle
+
+        # 他のスレッドが読み込み中であれば、読み込み終わるまでは古いモデルを使う
+        if bundle is not None and not self._lock.acquire(blocking=False):
+            return bundle
+        if bundle is None:
+            self._lock.acquire()
+
+        try:
+            bundle = self._bundles.get(self.key)
+            if self._is_fresh(bundle, time.monotonic()):
+                return bundle
+
+            if bundle is not None:
+                try:
+                    version = self._get_version()
+                except Exception as e:
+                    # Redisに接続できない場合は読み込み済みのモデルを使い続ける
+                    app.logger.warning(
+                        'Model version check is failed. Reason: {0}'.format(e))
+                    Model._checked[self.key] = time.monotonic()
+                    return bundle
+
+                if version == bundle.version:
+                    Model._checked[self.key] = time.monotonic()
+                    return bundle
+
+            try:
+                loaded = self._load()
+            except Exception as e:
+                if bundle is None:
+                    raise
+                app.logger.warning(
+                    'Model reload is failed. Reason: {0}'.format(e))
+                Model._checked[self.key] = time.monotonic()
+                return bundle
+
+            # 参照の差し替えだけで入れ替える
+            Model._bundles[self.key] = loaded
+            Model._checked[self.key] = time.monotonic()
+            app.logger.info('Model is loaded. version: {0}'.format(
+                loaded.version))
+
+            return loaded
+        finally:
+            self._lock.release()
+
+    @classmethod
+    def clear(cls):
+        '''
+        キャッシュを全て破棄する
+        '''
+        with cls._lock:
+            cls._bundles.clear()
+            cls._checked.clear()
@@ -2,30 +2,114 @@
 
 import difflib
 import os
+from collections import Counter
 from multiprocessing import Pool
 
 from app import app
+from app.ml.corpus import SharedCorpus
+from app.ml.minhash import LSH, MinHash
 from app.redis.objects import Objects as Redis_objects
 from app.redis.connect import Connect
+from app.redis.lsh import LSHIndex
+from app.utility.metrics import Metrics
 
 
 class Overlap():
     '''
     重複テキストを削除するための処理
     Redisに保存されているデータを削除する
+
+    全件どうしをSequenceMatcherで比較すると件数の2乗の時間がかかるので、
+    MinHash/LSHでbucketが一致したものだけを候補にして、候補とだけ比較する。
+    候補から漏れる確率はOVERLAP_LSH_BANDS, OVERLAP_LSH_ROWSで調整する。MinHashを参照
+    exact=Trueの場合はLSHで絞り込まずに全ての組み合わせを比較する。
+    LSHで取りこぼしていないかを確認する時に使う
     '''
 
-    def is_overlap(self, item, items_comparision):
+    # key: (id, body), value: bucketのlist
+    # is_overlapが呼ばれる度に、比較対象のsignatureを作り直さないためのキャッシュ
+    _buckets = {}
+
+    # remove_myselfで使う。forkしたworkerはpickleせずにそのまま参照する
+    # id, bodyはSharedCorpusに入れ、workerごとにコピーされないようにする
+    _ids = None
+    _bodies = None
+    _index = None
+
+    def __init__(self):
+        # _is_similarの段階ごとの件数
+        self.stats = Counter()
+
+    def _is_similar(self, body, body_c, counter=None):
         '''
-        重複度が90%以上のものがあるかないかを返す
+        90%以上重複しているテキストは重複しているものとする
         80%や70%のように削りすぎるのもよくないということがわかった
+
+        SequenceMatcher.ratioは遅いので、ratioを超えない値で先に判定し、
+        しきい値以下であればratioを計算せずに重複していないとする。結果はratioと同じになる
+        1. 同じ文字列であれば重複している
+        2. 文字数だけで分かる上限 2 * min / (a + b) (real_quick_ratioと同じ値)
+        3. 文字ごとの出現回数だけで分かる上限 (quick_ratioと同じ値)
+        4. ratio
+        @param string body
+        @param string body_c
+        @param Counter counter bodyの文字ごとの出現回数。同じbodyで何度も呼ぶ場合に渡す
+        @return bool
+        '''
+        threshold = app.config['OVERLAP_THRESHOLD']
+
+        if body == body_c:
+            self.stats['identical'] += 1
+            # 同じ文字列のratioは1.0
+            return 1.0 > threshold
+
+        length = len(body) + len(body_c)
+        if 2.0 * min(len(body), len(body_c)) / length <= threshold:
+            self.stats['length'] += 1
+            return False
+
+        if counter is None:
+            counter = Counter(body)
+        matches = sum((counter & Counter(body_c)).values())
+        if 2.0 * matches / length <= threshold:
+            self.stats['quick_ratio'] += 1
+            return False
+
+        s = difflib.SequenceMatcher(None, body, body_c)
+        if s.ratio() > threshold:
+            self.stats['ratio_matched'] += 1
+            return True
+
+        self.stats['ratio_rejected'] += 1
+        return False
+
+    def _get_buckets(self, minhash, item):
+        '''
+        @param MinHash minhash
+        @param tuple item e.g. (id, 'body')
+        @return list of string
+        '''
+        buckets = self._buckets.get(item)
+        if buckets is None:
+            buckets = minhash.buckets(minhash.signature(item[1]))
+            self._buckets[item] = buckets
+
+        return buckets
+
+    def is_overlap(self, item, items_comparision, exact=False):
+        '''
+        重複度が90%以上のものがあるかないかを返す
         重複していればTrueを返す。
         @param tuple item
           e.g. (id, 'body')
         @param list of tuple items_comparision
           e.g. [(id, body),...]
+        @param bool exact Trueであればbucketで絞り込まずに全て比較する
         @return bool
         '''
+        minhash = MinHash()
+        buckets = None if exact else minhash.buckets(minhash.signature(item[1]))
+        counter = Counter(item[1])
 
         for item_c in items_comparision:
 
@@ -33,71 +117,127 @@ class Overlap():
             if item[0] == item_c[0]:
                 continue
 
-            s = difflib.SequenceMatcher(None, item[1], item_c[1])
+            # どのbandもbucketが一致しなければ候補にしない
+            if buckets is not None:
+                buckets_c = self._get_buckets(minhash, item_c)
+                if not any(b == b_c for b, b_c in zip(buckets, buckets_c)):
+                    continue
 
-            # 90%以上重複しているテキストは重複しているものとする
-            if s.ratio() > 0.9:
+            if self._is_similar(item[1], item_c[1], counter):
                 return True
 
         return False
 
-    def _remove(self, item):
+    def _remove(self, i):
         '''
-        @param tuple item
-            e.g. (id, body)
+        @param int i _ids, _bodiesの何番目か
+        @return tuple (list of string 削除するid, dict _is_similarの段階ごとの件数)
         '''
+        obj_id = int(self._ids[i])
+        body = self._bodies[i]
+        counter = Counter(body)
+        self.stats = Counter()
 
-        with Redis_objects() as r:
-            items_c = r.get(self.key_name, reversed_flag=False)
+        del_items = []
 
-        if os.environ.get('ENVIRONMENT') == 'development':
-            items_c_len = len(items_c)
-            # 全て表示させると遅くなるので、3の倍数の時だけ出力
-            if (items_c_len % 3) == 0:
-                print('{0}, Laps: {1}/{2}'.format(
-                    self.key_name, str(items_c_len), self.items_len)
-                )
+        # _indexがない場合(exact=True)は全件と比較する
+        if self._index is None:
+            candidates = range(len(self._ids))
+        else:
+            candidates = self._index.candidates(body)
 
-        del_items = set([])
-
-        for item_c in items_c:
+        for j in candidates:
+            obj_id_c = self._ids[j]
             # 自分自身の場合はスキップ
             # 対処済みitemの場合はスキップ
-            if item[0] == item_c[0] or int(item[0]) > int(item_c[0]):
+            if obj_id >= int(obj_id_c):
                 continue
 
-            s = difflib.SequenceMatcher(None, item[1], item_c[1])
-
-            if s.ratio() > 0.9:
-                del_items.add(item_c[0])
+            if self._is_similar(body, self._bodies[j], counter):
+                del_items.append(obj_id_c)
 
-        # 一周ごとにまとめて削除
-        if del_items:
-            Connect().open().hdel(self.key_name, *del_items)
+        return del_items, self.stats
 
-    def remove_myself(self, key_name):
+    def remove_myself(self, key_name, exact=False):
         '''
         初期時に使用するためのメソッド
         重複データをredisから消す
         重複を含めて、key_nameに全てのデータが入っているものとする
+        各itemについて、自分よりidが大きく重複しているものを消す
         @param string key_name
+        @param bool exact Trueであれば、LSHで絞り込まずに全ての組み合わせを比較する
         '''
 
         app.logger.debug('remove_myself start')
 
         self.key_name = key_name
 
-        # 全て取得
+        # 全て取得。hgetallはここで1度だけ行う
         with Redis_objects() as r:
             # @return list of tuple
             # e.g. [(id, body),...]
             items = r.get(key_name, reversed_flag=False)
 
-        self.items_len = str(len(items))
+        # indexとcorpusはmasterで1度だけ作り、workerにはforkで引き継ぐ
+        index = None
+        if not exact:
+            index = LSH()
+            for i, item in enumerate(items):
+                index.add(i, item[1])
 
-        with Pool(processes=app.config['POOL_PROCESS_NUM']) as pool:
-            # chunksizeを設定しなければ、mapに1つずつitemsのデータが渡される
-            # chunksizeに100を指定すれば、100個ずつ渡される。10倍くらいの差が出る
-            pool.map(self._remove, items, chunksize=100)
+        Overlap._ids = SharedCorpus([item[0] for item in items])
+        Overlap._bodies = SharedCorpus([item[1] for item in items])
+        Overlap._index = index
+
+        count = len(items)
+        del items
+
+        del_items = set([])
+
+        try:
+            with Pool(processes=app.config['POOL_PROCESS_NUM']) as pool:
+                # workerにはindexの番号だけ渡す
+                # chunksizeに100を指定すれば、100個ずつ渡される
+                results = pool.imap_unordered(
+                    self._remove, range(count), chunksize=100)
+
+                for laps, (ids, stats) in enumerate(results, 1):
+                    del_items.update(ids)
+                    self.stats.update(stats)
+
+                    if os.environ.get('ENVIRONMENT') == 'development' and \
+                            laps % 1000 == 0:
+                        print('{0}, Laps: {1}/{2}, Deleted: {3}'.format(
+                            key_name, laps, count, len(del_items)))
+        finally:
+            Overlap._ids = None
+            Overlap._bodies = None
+            Overlap._index = None
+
+        # workerの結果をまとめて、1回の通信で削除する。LSHIndexからも削除する
+        del_items = list(del_items)
+        with Connect().open().pipeline(transaction=False) as pipe:
+            for i in range(0, len(del_items), 1000):
+                pipe.hdel(key_name, *del_items[i:i + 1000])
+            pipe.execute()
+
+        index = LSHIndex(key_name)
+        for i in range(0, len(del_items), 1000):
+            index.remove(*del_items[i:i + 1000])
+
+        app.logger.debug('remove_myself finish. deleted: {0}'.format(
+            len(del_items)))
+        self._log_stats(key_name)
+
+    def _log_stats(self, key_name):
+        '''
+        _is_similarの段階ごとの件数をログに出し、Metricsに加算する
+        @param string key_name
+        '''
+        app.logger.info('Overlap {0} {1}'.format(key_name, ', '.join(
+            '{0}: {1}'.format(k, v) for k, v in sorted(self.stats.items()))))
 
-        app.logger.debug('remove_myself finish')
+        metrics = Metrics('overlap')
+        for stage, count in self.stats.items():
+            metrics.incr(stage, count)
+        metrics.flush(force=True)
@@ -0,0 +1,120 @@
+# coding: utf-8
+
+import queue
+import threading
+import time
+
+from app import app
+from app.utility.metrics import Metrics
+
+
+class Pipeline():
+    '''
+    複数の段階からなる処理を、段階ごとのスレッドで並行に実行する
+    _detect_msgの大半はMySQL, HTTP, Redisの待ち時間なので、1件ずつ順番に処理すると
+    CPUが空いている時間が長い。段階ごとに別のスレッドで実行すれば、
+    あるmessageの分かち書きと別のmessageのINSERTを同時に進められる
+
+    - 段階ごとにPIPELINE_CONCURRENCYで指定した数のスレッドを持つ
+    - 段階の間のキューは最大PIPELINE_QUEUE_SIZE件。
+      次の段階が詰まっていれば前の段階は待つので、submitも含めて無限に溜まることはない
+    - 1件の処理が終わるか、いずれかの段階で例外が発生するとon_doneを呼び出す
+
+    Metrics('pipeline')に段階ごとの処理時間 {name}_ms を記録する
+    '''
+
+    # スレッドを終了させるための値
+    _STOP = object()
+
+    def __init__(self, stages, on_done):
+        '''
+        @param list of tuple stages (str 名前, callable)
+            各段階は前の段階の返り値を受け取り、次の段階に渡す値を返す。
+            Noneを返した場合はそこで終了する
+        @param callable on_done on_done(key, error)
+            errorは成功した場合はNone
+        '''
+        self.stages = stages
+        self.on_done = on_done
+        self.metrics = Metrics('pipeline')
+
+        size = app.config['PIPELINE_QUEUE_SIZE']
+        self.queues = [queue.Queue(maxsize=size) for _ in stages]
+
+        self._inflight = 0
+        self._cond = threading.Condition()
+
+        self.threads = []
+        for i, (name, fn) in enumerate(stages):
+            for _ in range(app.config['PIPELINE_CONCURRENCY'][name]):
+                t = threading.Thread(target=self._work, args=(i,))
+                t.daemon = True
+                t.start()
+                self.threads.append((i, t))
+
+    def submit(self, key, value):
+        '''
+        最初の段階に渡す。キューが埋まっていれば空くまで待つ
+        @param key on_doneに渡す値
+        @param value 最初の段階に渡す値
+        '''
+        with self._cond:
+            self._inflight += 1
+
+        self.queues[0].put((key, value))
+
+    def _finish(self, key, error):
+        try:
+            self.on_done(key, error)
+        except Exception as e:
+            app.logger.error(
+                'Pipeline on_done is failed. Reason: {0}'.format(e))
+
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+
+    def _work(self, i):
+        name, fn = self.stages[i]
+        last = i == len(self.stages) - 1
+
+        while True:
+            task = self.queues[i].get()
+            if task is self._STOP:
+                return
+
+            key, value = task
+
+            started = time.monotonic()
+            try:
+                value = fn(value)
+            except Exception as e:
+                self._finish(key, e)
+                continue
+            finally:
+                self.metrics.observe(
+                    name + '_ms', (time.monotonic() - started) * 1000)
+
+            if value is None or last:
+                self._finish(key, None)
+            else:
+                self.queues[i + 1].put((key, value))
+
+    def join(self):
+        '''
+        submitした全ての処理が終わるまで待つ
+        '''
+        with self._cond:
+            while self._inflight:
+                self._cond.wait()
+
+    def close(self):
+        '''
+        処理中の分が終わるのを待ってから、スレッドを終了させる
+        '''
+        self.join()
+
+        for i, t in self.threads:
+            self.queues[i].put(self._STOP)
+        for i, t in self.threads:
+            t.join()
@@ -1,19 +1,19 @@
 # coding: utf-8
 
 import json
-import pickle
-import gzip
 import pytz
 from datetime import datetime
 from app import app
 from app.mysql.works import Works as Mysql_works
 from app.mysql.work_spams import WorkSpams
 from app.mysql.messages import Messages as Mysql_messages
-from app.mysql.message_spams import MessageSpams
+from app.mysql.message_spams import MessageSpamsWriter
 from app.redis.connect import Connect
 from app.ml.biz_filter import BizFilter
+from app.ml.model import Model
 from app.ml.wakati import Wakati
 from app.utility.chatwork import Chatwork
+from app.utility.detected_users import DetectedUsers
 from app.utility.scraper import Scraper
 from app.utility.websocket import Websocket
 
@@ -23,14 +23,13 @@ class Predict():
     対象がスパムか否かを予測する
     '''
 
-    def __init__(self, vect=None, lsa=None, clf=None):
+    def __init__(self, model=None, version=None):
         '''
-        @param str body
-        @param str
+        @param str model Train.runがモデルを保存したhashのキー
+        @param str version Train.runがincrするバージョンキー
         '''
-        self.vect = vect
-        self.lsa = lsa
-        self.clf = clf
+        self.model = model
+        self.version = version
 
     def _factory_msg(self, message_id):
         '''
@@ -105,38 +104,34 @@ class Predict():
     def _create_msg(self, item):
         '''
         予測した結果をSave
+        他のmessageの結果とまとめて書き込み、commitされるまで待つ
         @param dict item
-        @return int id item created
         '''
 
         if not item['biz_filter']:
-            biz_filter = None
+            # createで文字列に埋め込んでいた頃と同じ値を保存する
+            biz_filter = 'None'
         else:
             biz_filter = json.dumps(item['biz_filter'])
 
-        with MessageSpams() as ms:
-            item_id = ms.create((
-                item['board_id'],
-                item['message_id'],
-                item['score'],
-                item['predict'],
-                biz_filter
-            ))
-
-        return item_id
+        MessageSpamsWriter.get().write((
+            item['board_id'],
+            item['message_id'],
+            item['score'],
+            item['predict'],
+            biz_filter
+        ))
 
-    def _get_vocabulary(self, vect, transform):
+    def _get_vocabulary(self, vocabulary, transform):
         '''
         TF-IDF値の高い単語を取得する
         次元圧縮後の特徴を使うのでTF-IDF値の高い値が使用されているとは限らないが、
         参考にはなるので保存する
+        @param dict vocabulary {idx: word}
+        @param transform 1行分のTF-IDF値
         @return str
             e.g. ロゴ 社名 バイク 当社 希望 デザイン 高級
         '''
-        vocabulary = {}
-        for word, idx in vect.vocabulary_.items():
-            vocabulary.update({idx: word})
-
         mapping = {}
         for i, idx in enumerate(transform.indices):
             mapping.update({
@@ -151,13 +146,18 @@ class Predict():
 
         return ' '.join([vocabulary[m_s[0]] for m_s in m_sorted][0:18])
 
-    def _get_score(self, clf, lsa):
+    def _get_score(self, bundle, tfidf):
         '''
-        @param lsa lsaで次元圧縮した値を渡すこと
-        @return str
+        @param Bundle bundle
+        @param tfidf TF-IDF値
+        @return tuple list of int predicts, list of str scores
         '''
-        score = clf.decision_function(lsa)
-        return str(score[0])
+        # PREDICT_FUSEDがTrueであれば、疎ベクトルと重みベクトルの内積1回で済む
+        scores = bundle.decision_function(
+            tfidf, fused=app.config['PREDICT_FUSED'])
+        predicts = bundle.predict(scores)
+
+        return [int(p) for p in predicts], [str(score) for score in scores]
 
     def _notify_msg(self, item, debug=False):
         '''
@@ -167,18 +167,10 @@ class Predict():
         '''
 
         if not debug:
-            r = Connect(role='slave').open()
-            # 検知済みuserの取得
-            # @return set型
-            spam_user_ids = r.smembers(app.config['MSG_DETECTED_USER_ID'])
-
             # 通知済みのuserの場合は通知しない
-            if str(item['user_id']) in spam_user_ids:
-                return None
-
             # 違反判定されたmessageの作成者の場合は追加して、次から通知しないようにする
-            r_m = Connect().open()
-            r_m.sadd(app.config['MSG_DETECTED_USER_ID'], item['user_id'])
+            if not DetectedUsers().add(item['user_id']):
+                return None
 
         chatwork = Chatwork()
         res = chatwork.post(
@@ -201,38 +193,64 @@ class Predict():
         @param str body
         @return dict
         '''
-        # decode_responses=Falseにするためにメソッド内で呼び出している
-        con = Connect(role='slave', decode_responses=False)
-        r_s = con.open()
+        # 1度に1つの対象をpredictするので、0番目を返す
+        return self._predict_many([body])[0]
 
-        with r_s.pipeline(transaction=False) as pipe:
-            pipe.get(self.vect)
-            pipe.get(self.lsa)
-            pipe.get(self.clf)
-            pickles = pipe.execute()
+    def _predict_batched(self, body):
+        '''
+        同時に呼び出された他のpredictとまとめて実行する
+        まとめない設定の場合はそのまま実行する。Batcher.is_enabledを参照
+        @param str body 分かち書き済みの文字列
+        @return dict
+        '''
+        # Batcherはこのモジュールをimportしているので、ここでimportする
+        from app.ml.batcher import Batcher
 
-        # バイナリーに戻す
-        vect = pickle.loads(gzip.decompress(pickles[0]))
-        lsa = pickle.loads(gzip.decompress(pickles[1]))
-        clf = pickle.loads(gzip.decompress(pickles[2]))
+        if not Batcher.is_enabled():
+            return self._predict(body)
 
-        # TFIDFはiterableな値しか受けつけないので、リストで渡す
-        tfidf = vect.transform([body])
-        lsa_reduced = lsa.transform(tfidf)
-        predict = clf.predict(lsa_reduced)
+        return Batcher.get(model=self.model, version=self.version).run(body)
 
-        score = self._get_score(clf, lsa_reduced)
+    def get_model(self):
+        '''
+        プロセス内にキャッシュしたモデルを返す
+        配列は必ず同じ学習で作られた組になっている
+        @return Bundle
+        '''
+        return Model(model=self.model, version=self.version).get()
 
-        vocabulary = self._get_vocabulary(vect, tfidf)
+    def _predict_many(self, bodies, bundle=None, tokens=False):
+        '''
+        複数の対象をまとめてpredictする
+        TF-IDF, LSA, clfはそれぞれ1回ずつしか実行しない
+        @param list of str bodies 分かち書き済みの文字列
+        @param Bundle bundle
+            Noneの場合はget_modelで取得する。
+            Executorで実行する場合は、Redisへの通信を避けるため事前に取得して渡す
+        @param bool tokens Trueの場合、bodiesはWakati.tokensの結果のリスト
+        @return list of dict bodiesと同じ順番で返す
+        '''
+        if bundle is None:
+            bundle = self.get_model()
 
-        # 1はspam、0はspamではない
-        return {
-            # 1度に1つの対象をpredictすることを想定しているので、0番目を返す
-            # predict[0]は <class 'numpy.int64'>型になっているのでintにする
-            'predict': int(predict[0]),
-            'score': score,
-            'vocabulary': vocabulary
-        }
+        if tokens:
+            tfidf = bundle.transform_tokens(bodies)
+        else:
+            tfidf = bundle.transform(bodies)
+
+        predicts, scores = self._get_score(bundle, tfidf)
+
+        items = []
+        for i, predict in enumerate(predicts):
+            # 1はspam、0はspamではない
+            items.append({
+                'predict': predict,
+                'score': scores[i],
+                'vocabulary': self._get_vocabulary(
+                    bundle.vocabulary, tfidf[i])
+            })
+
+        return items
 
     def _detect_pjt(self, work_id):
         '''
@@ -295,21 +313,63 @@ class Predict():
         # 2.90以上だとほぼほぼspam。
         # 0.x台はspamではないことが多い
         # 1.x~1.9は、一斉送信営業メールである確率が高い
+        各段階はPipelineでも使うので、_stage_msg_*に分けている
         @param int message_id
         '''
 
+        item = message_id
+        for name, stage in self.stages_msg():
+            item = stage(item)
+            # Noneが返ればそこで終了
+            if item is None:
+                return None
+
+    def stages_msg(self):
+        '''
+        _detect_msgの各段階を順番に返す
+        各段階は前の段階の返り値を受け取り、次の段階に渡す値を返す。
+        Noneを返した場合はそこで終了する
+        @return list of tuple (str 名前, callable)
+        '''
+        return [
+            ('fetch', self._stage_msg_fetch),
+            ('predict', self._stage_msg_predict),
+            ('scrape', self._stage_msg_scrape),
+            ('save', self._stage_msg_save),
+            ('notify', self._stage_msg_notify),
+        ]
+
+    def _stage_msg_fetch(self, message_id):
+        '''
+        MySQLからboardのmessageを取得する
+        @param int message_id
+        @return dict | None
+        '''
         item = self._factory_msg(message_id)
 
         if not item:
             return None
 
+        return item
+
+    def _stage_msg_predict(self, item):
+        '''
+        分かち書きしてpredictする
+        @param dict item
+        @return dict | None
+        '''
         # ビジネスルールの適用
         # msgの場合は分かち書きする前に適用する
         # bf = BizFilter()
         # res_bf = bf.msg(' '.join(data[1]))
 
-        predicted = self._predict(
-            Wakati().parse(' '.join(item['description'])))
+        # 同じ本文が大量に送られてくるので、キャッシュを経由する
+        # PredictCacheはこのモジュールをimportしているので、ここでimportする
+        from app.ml.cache import PredictCache
+        predicted = PredictCache(
+            model=self.model,
+            version=self.version
+        ).run(' '.join(item['description']))
 
         '''
         itemに対して_predictの結果をマージ
@@ -328,13 +388,20 @@ class Predict():
         '''
         item.update(predicted)
 
-        score = float(item['score'])
-
         # SCORE_THRESHOLD_MSG_SCRAPE未満であれば何もしない。終了
-        if score < app.config['SCORE_THRESHOLD_MSG_SCRAPE']:
+        if float(item['score']) < app.config['SCORE_THRESHOLD_MSG_SCRAPE']:
             return None
 
-        # spamだとは断定できないが、怪しい場合は、urlチェック
+        return item
+
+    def _stage_msg_scrape(self, item):
+        '''
+        spamだとは断定できないが、怪しい場合は、urlチェック
+        @param dict item
+        @return dict | None
+        '''
+        score = float(item['score'])
+
         if score >= app.config['SCORE_THRESHOLD_MSG_SCRAPE'] and \
             score < app.config['SCORE_THRESHOLD_MSG_SPAM']:
 
@@ -348,9 +415,24 @@ class Predict():
 
             item['biz_filter'] = res_sc
 
-        # Create message_spams record
+        return item
+
+    def _stage_msg_save(self, item):
+        '''
+        Create message_spams record
+        @param dict item
+        @return dict
+        '''
         self._create_msg(item)
 
+        return item
+
+    def _stage_msg_notify(self, item):
+        '''
+        Chatworkへの通知と、clientへのemit
+        @param dict item
+        @return dict
+        '''
         # Notification to Chatwork
         self._notify_msg(item)
 
@@ -363,6 +445,8 @@ class Predict():
             'predict': item['predict']
         })
 
+        return item
+
     def debug(self, message_id):
         '''
         @param int message_id
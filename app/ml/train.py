@@ -1,12 +1,13 @@
 # coding: utf-8
 
-import pickle
-import gzip
+import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.linear_model import PassiveAggressiveClassifier
 from sklearn.decomposition import TruncatedSVD
 
 from app import app
+from app.ml.artifact import Artifact
+from app.ml.model import Bundle
 from app.redis.objects import Objects as Redis_objects
 from app.redis.connect import Connect
 
@@ -17,11 +18,14 @@ class Train():
     worksとmessagesのtfidfパラメータは同じで問題なし
     '''
 
-    def __init__(self, tfidf_key=None, lsa_key=None, clf_key=None):
-        ''''''
-        self.tfidf_key = tfidf_key
-        self.lsa_key = lsa_key
-        self.clf_key = clf_key
+    def __init__(self, model_key=None, version_key=None):
+        '''
+        @param str model_key モデルを保存するhashのキー
+        @param str version_key
+            学習の度にincrする。Predict側はこの値が変わったらモデルを読み込み直す
+        '''
+        self.model_key = model_key
+        self.version_key = version_key
 
     def set_datasets(self, pos_key=None, neg_key=None, add_key=None):
         '''
@@ -65,6 +69,31 @@ class Train():
 
             i = i + 1
 
+    def _check(self, fields, tfidf_transform, clf, lsa_transform):
+        '''
+        保存する形式から組み立てたモデルのTF-IDF値、score(fused, lsa >> clfの両方)が
+        sklearnと一致するかを学習データ全件で確認する
+        一致しなければ保存せずに例外を投げる
+        fusedはLSAもclfのdecision_functionも線形であることを利用して
+        1本の重みベクトルにまとめたもの
+        '''
+        manifest, arrays = Artifact().loads(fields)
+        bundle = Bundle(None, manifest, arrays)
+
+        tfidf = bundle.transform(self.items['x'])
+        diff = abs(tfidf - tfidf_transform).max()
+        if diff > 1e-6:
+            raise Exception('TF-IDF is diverged. max diff: {0}'.format(diff))
+
+        score = clf.decision_function(lsa_transform)
+
+        for fused in [True, False]:
+            score_bundle = bundle.decision_function(tfidf, fused=fused)
+            if not np.allclose(score_bundle, score, rtol=1e-4, atol=1e-4):
+                raise Exception(
+                    'Score is diverged. fused: {0}, max diff: {1}'.format(
+                        fused, np.max(np.abs(score_bundle - score))))
+
     def run(self):
         '''
         @return None
@@ -105,22 +134,23 @@ class Train():
 
         clf_fit = clf.fit(lsa_transform, self.items['y'])
 
-        # Convert to binary
-        tfidf_pickle = gzip.compress(
-            pickle.dumps(tfidf_fit, pickle.HIGHEST_PROTOCOL)
-        )
+        # sklearnのオブジェクトではなく配列だけを保存する
+        artifact = Artifact()
+        fields = artifact.dumps(artifact.build(tfidf_fit, lsa_fit, clf_fit))
 
-        lsa_pickle = gzip.compress(
-            pickle.dumps(lsa_fit, pickle.HIGHEST_PROTOCOL)
-        )
-
-        clf_pickle = gzip.compress(
-            pickle.dumps(clf_fit, pickle.HIGHEST_PROTOCOL)
-        )
+        self._check(fields, tfidf_transform, clf_fit, lsa_transform)
+        self._save(fields)
 
+    def _save(self, fields):
+        '''
+        読み取り側が異なる学習の配列を混ぜて読み込まないように
+        hashとバージョンをMULTIでまとめて書き込む
+        @param dict fields Artifact.dumpsの結果
+        '''
         r = Connect().open()
-        with r.pipeline(transaction=False) as pipe:
-            pipe.set(self.tfidf_key, tfidf_pickle)
-            pipe.set(self.lsa_key, lsa_pickle)
-            pipe.set(self.clf_key, clf_pickle)
+        with r.pipeline(transaction=True) as pipe:
+            pipe.delete(self.model_key)
+            pipe.hmset(self.model_key, fields)
+            if self.version_key:
+                pipe.incr(self.version_key)
             pipe.execute()
@@ -2,26 +2,54 @@
 
 import os
 import pytz
+from collections import deque
 from datetime import datetime, timedelta
+from itertools import groupby, islice
 from multiprocessing import Pool
 
 from app import app
+from app.ml.minhash import LSH
 from app.ml.overlap import Overlap
 from app.ml.wakati import Wakati
 from app.mysql.works import Works as Mysql_works
 from app.mysql.messages import Messages as Mysql_messages
 from app.redis.connect import Connect
-from app.redis.objects import Objects as Redis_objects
+from app.redis.lsh import LSHIndex
 
 
 class Update:
     '''
     positive, negativeデータを更新する
+
+    obj_typeごとに最後に読み込んだidをUPDATE_LAST_IDに保存し、毎日のrunでは
+    それより後のデータだけを読み込む。読み込む量は前回からの追加分だけになる
+
+    Positiveはblackedのユーザのデータなので、idを過ぎた後にblackedになったユーザの
+    データはidだけでは読み込まれない。これはfull=Trueのrunを週に1度など
+    毎日より少ない頻度で別に実行し、days_ago日前の17:00:00以降を読み込み直して拾う
+    読み込み直したもののうち追加済みのものは、重複として扱われる
     '''
 
-    def __init__(self, key_name=None, obj_type=None, days_ago=2):
+    def __init__(self, key_name=None, obj_type=None, days_ago=2,
+                 full=False, exact=False):
+        '''
+        @param string key_name DATASETS_*のキー
+        @param string obj_type
+        @param int days_ago
+            full=Trueの場合と、UPDATE_LAST_IDがない場合に
+            何日前の17:00:00以降のデータを読み込むか
+        @param bool full
+            Trueの場合はUPDATE_LAST_IDを使わずにdays_ago以降を全て読み込み直す
+            idを過ぎた後にblackedになったユーザのデータを拾うためのもので、
+            前回のfullのrunからの日数以上のdays_agoで、毎日より少ない頻度で実行する
+        @param bool exact
+            Trueの場合はLSHIndexで絞り込まずに、保存済みの全件と比較する
+            LSHで取りこぼしていないかを確認する時に使う
+        '''
         self.key_name = key_name
         self.days_ago = int(days_ago)
+        self.full = full
+        self.exact = exact
 
         if obj_type not in ['pjt_mlm', 'pjt_vl', 'msg']:
             raise Exception('obj_type must be pjt_mlm, pjt_vl or msg')
@@ -47,111 +75,155 @@ class Update:
 
         return days_ago, today_five,
 
-    def _get_pjt(self, work_type=None):
+    def _get_last_id(self):
         '''
-        @return list of tuple
-            [(b_id, [b_body]),...]
+        前回のrunで最後に読み込んだid
+        @return int or None
         '''
+        r = Connect(role='master').open()
+        last_id = r.get(app.config['UPDATE_LAST_ID'].format(self.obj_type))
 
-        days_ago, today_five = self._get_date()
+        return int(last_id) if last_id else None
 
-        # 2日前以降、本日17:00:00までのPositiveデータを取得
-        with Mysql_works(role='slave') as m:
+    def _iter_pjt(self, after_this_id=None, work_type=None):
+        '''
+        after_this_idより後のPositiveデータを、全件をメモリに載せずに読み込む
+        after_this_idがない場合は、days_ago日前の17:00:00以降を読み込む
+        読み込んだidの最大値はself.max_idに入れる
+        @param int after_this_id
+        @param string work_type
+        @return generator of tuple
+            (b_id, [b_body])
+        '''
+
+        days_ago, _ = self._get_date()
+        size = app.config['UPDATE_FETCH_SIZE']
+
+        with Mysql_works(role='slave', buffered=False) as m:
             if work_type == 'mlm':
-                items = m.get_pos(days_ago, today_five)
+                items = m.iter_pos(after_this_id, days_ago, size)
 
             if work_type == 'vl':
-                items = m.get_vl_pos(days_ago, today_five)
+                items = m.iter_vl_pos(after_this_id, days_ago, size)
 
-        works = []
-        # Convert to list of tuple
-        for item in items:
-            if not item['title'] or not item['description']:
-                continue
+            for item in items:
+                self.max_id = max(self.max_id, item['id'])
 
-            # わざわざ変数に入れる必要はないが、1行が長くならないようにするための対応
-            title = item['title'].decode('utf-8')
-            desc = item['description'].decode('utf-8')
+                if not item['title'] or not item['description']:
+                    continue
 
-            works.append((item['id'], [title + ' ' + desc]))
+                # わざわざ変数に入れる必要はないが、1行が長くならないようにするための対応
+                title = item['title'].decode('utf-8')
+                desc = item['description'].decode('utf-8')
 
-        return works
+                yield (item['id'], [title + ' ' + desc])
 
-    def _get_msg(self):
+    def _iter_msg(self, after_this_id=None):
         '''
-        @return list of tuple
-            [(b_id, [b_body]),...]
+        _iter_pjtのmsg版。同じboard_idのdescriptionをまとめる
+        iter_posはboard_idの順に返すので、連続している間だけまとめればよい
+        @param int after_this_id
+        @return generator of tuple
+            (b_id, [b_body1, b_body2,...])
         '''
 
-        days_ago, today_five = self._get_date()
+        days_ago, _ = self._get_date()
+        size = app.config['UPDATE_FETCH_SIZE']
 
-        with Mysql_messages(role='slave') as m:
-            msg_latest = m.get_pos(days_ago, today_five)
+        with Mysql_messages(role='slave', buffered=False) as m:
+            items = m.iter_pos(after_this_id, days_ago, size)
 
-        # 同じboard_idのdescriptionをまとめる。こういう形式にする。
-        # [{'board_id1': ['description1', 'description2']},
-        #  {'board_id2': ['description']},...}]
-        boards_dict = {}
-        for item in msg_latest:
-            if item['board_id'] in boards_dict:
-                boards_dict[item['board_id']].append(
-                    item['description'].decode('utf-8')
-                )
-            else:
-                boards_dict[item['board_id']] = [
-                    item['description'].decode('utf-8')
-                ]
+            for b_id, group in groupby(items, key=lambda item: item['board_id']):
+                b_body = []
+                for item in group:
+                    self.max_id = max(self.max_id, item['id'])
+                    b_body.append(item['description'].decode('utf-8'))
 
-        # Convert to list of tuple
-        return [(b_id, b_body) for b_id, b_body in boards_dict.items()]
+                yield (b_id, b_body)
 
-    def _add(self, item):
+    def _check(self, item_tup, items_c=None):
         '''
-        @param tuple
-            e.g. (b_id, [b_body, b_body])
-        @return dict
+        Redisに保存済みのデータと重複しているかを調べる
+        workerで実行するので、ここでは書き込まない。書き込みは_writeでまとめて行う
+        @param tuple 分かち書き済みのitem
+            e.g. (b_id, 'body')
+        @param list of tuple items_c 比較対象。exact=Trueの場合は保存済みの全件
+        @return tuple (bool 重複していればTrue, Counter Overlapで比較した段階ごとの件数)
         '''
 
-        if self.obj_type == 'pjt_mlm' or self.obj_type == 'pjt_vl':
-            # 比較対象のitemsをセット
-            # 追加しようとしているデータ集合の中に重複しているものが全然あるので、追加するたびに、
-            # redisから全部取得 >> 追加しようとしているデータとの重複チェック >> セット
-            # redisから全部取得 >> ... というredisとのi/oが無駄に多い処理を行う
-            with Redis_objects() as r:
-                items_c = r.get(self.key_name, reversed_flag=False)
-
-            wakati = Wakati()
-            item_tup = (item[0], wakati.parse(' '.join(item[1])),)
-
-        if self.obj_type == 'msg':
-            with Redis_objects() as r:
-                items_c = r.get(self.key_name, reversed_flag=False)
+        if items_c is None:
+            # 比較対象は、LSHIndexでbucketが一致したものだけ取得する
+            # hashを全件取得して比較する必要はない
+            candidates = list(LSHIndex(self.key_name).query(item_tup[1]))
 
-            # descriptionを連結して、分かち書きにする
-            # ('board_id', 'dec1 dec2 dec3')
-            wakati = Wakati()
-            item_tup = (item[0], wakati.parse(' '.join(item[1])),)
+            items_c = []
+            if candidates:
+                r = Connect().open()
+                items_c = [
+                    (obj_id, body)
+                    for obj_id, body in zip(
+                        candidates, r.hmget(self.key_name, candidates))
+                    if body is not None]
 
         overlap = Overlap()
-        is_overlap = overlap.is_overlap(item_tup, items_c)
+        is_overlap = overlap.is_overlap(item_tup, items_c, exact=self.exact)
 
         if os.environ.get('ENVIRONMENT') == 'development':
             # False/:board_idだと重複していないテキストだということ
             print('{0}, Overlap: {1}/{2}'.format(
                 self.key_name,
                 str(is_overlap),
-                str(item[0])
+                str(item_tup[0])
             ))
 
-        if not is_overlap:
-            # ここでhmset実行
-            Connect().open().hmset(self.key_name, {
-                item_tup[0]: item_tup[1]
-            })
+        return is_overlap, overlap.stats
+
+    def _dedup(self, items, overlap):
+        '''
+        Redisのデータと重複していないitemどうしの重複を、メモリ上で取り除く
+        先に出てきたものを残す。workerの処理順によって結果が変わらないようにするため
+        @param list of tuple items e.g. [(b_id, 'body'),...]
+        @param Overlap overlap 比較した段階ごとの件数はこのstatsに加算する
+        @return list of tuple
+        '''
+        index = LSH()
+        accepted = []
+
+        for item in items:
+            if self.exact:
+                items_c = accepted
+            else:
+                items_c = [accepted[i] for i in index.candidates(item[1])]
+            if overlap.is_overlap(item, items_c, exact=self.exact):
+                continue
+
+            index.add(len(accepted), item[1])
+            accepted.append(item)
+
+        return accepted
+
+    def _write(self, items):
+        '''
+        hashとLSHIndexに、1回の通信でまとめて追加する
+        @param list of tuple items e.g. [(b_id, 'body'),...]
+        '''
+        if not items:
+            return
+
+        index = LSHIndex(self.key_name)
+        with Connect().open().pipeline(transaction=True) as pipe:
+            pipe.hmset(self.key_name, dict(items))
+            for obj_id, body in items:
+                index.add(obj_id, body, pipe=pipe)
+            pipe.execute()
 
     def run(self):
         '''
-        @param string key_name
+        前回のrunより後に追加されたデータ(full=Trueの場合はdays_ago以降のデータ)を
+        UPDATE_FETCH_SIZE件ずつ分かち書きと重複チェックをしてから追加する
+        最後まで処理できた場合だけ、読み込んだidをUPDATE_LAST_IDに保存する。
+        途中で失敗した場合は次回同じデータを読み込むが、追加済みのものは
+        重複として扱われるので二重には追加されない
         @return None
         '''
 
@@ -161,15 +233,69 @@ class Update:
         if not r_s.exists(self.key_name):
             raise Exception('The key dose not exist in Redis')
 
+        # indexがない、またはhashと件数が合わない場合は作り直す
+        index = LSHIndex(self.key_name)
+        if not index.exists():
+            index.rebuild()
+
+        # full=Trueの場合もidは戻さない。次の毎日のrunは前回の続きから読み込む
+        last_id = self._get_last_id()
+        self.max_id = last_id or 0
+        after_this_id = None if self.full else last_id
+
         # GET DATA
         if self.obj_type == 'pjt_mlm':
-            items = self._get_pjt(work_type='mlm')
+            items = self._iter_pjt(after_this_id, work_type='mlm')
 
         if self.obj_type == 'pjt_vl':
-            items = self._get_pjt(work_type='vl')
+            items = self._iter_pjt(after_this_id, work_type='vl')
 
         if self.obj_type == 'msg':
-            items = self._get_msg()
+            items = self._iter_msg(after_this_id)
+
+        wakati = Wakati()
+        overlap = Overlap()
+        size = app.config['UPDATE_FETCH_SIZE']
+
+        # 分かち書きするbodyと同じ順に、idを入れておく
+        ids = deque()
+
+        def bodies():
+            # msgの場合はdescriptionを連結して、分かち書きにする
+            # ('board_id', 'dec1 dec2 dec3')
+            for item in items:
+                ids.append(item[0])
+                yield ' '.join(item[1])
+
+        # 分かち書きは全件を1つのPoolに流し、結果をUPDATE_FETCH_SIZE件ずつ取り出す
+        # Poolは最初に取り出す時に作られるので、MySQLに接続する前にforkする
+        parsed = wakati.parse_many(bodies())
 
         with Pool(processes=app.config['POOL_PROCESS_NUM']) as pool:
-            pool.map(self._add, items)
+            while True:
+                chunk = [(ids.popleft(), body) for body in islice(parsed, size)]
+                if not chunk:
+                    break
+
+                # 重複チェックはworkerで並列に行い、書き込みはchunkごとにまとめて行う
+                # 次のchunkは、このchunkで追加したものとも比較される
+                if self.exact:
+                    # 全件と比較するので、hashはchunkごとに1度だけ取得してmasterで比較する
+                    saved = list(Connect().open().hgetall(self.key_name).items())
+                    checked = [self._check(item, saved) for item in chunk]
+                else:
+                    checked = pool.map(self._check, chunk)
+                chunk = [
+                    item for item, (is_overlap, stats) in zip(chunk, checked)
+                    if not is_overlap]
+                for _, stats in checked:
+                    overlap.stats.update(stats)
+
+                self._write(self._dedup(chunk, overlap))
+
+        if self.max_id:
+            r = Connect(role='master').open()
+            r.set(app.config['UPDATE_LAST_ID'].format(self.obj_type),
+                  self.max_id)
+
+        overlap._log_stats(self.key_name)
@@ -1,12 +1,26 @@
 # coding: utf-8
 
 import MeCab
+import threading
 import unicodedata
-import re, os
+import re
+from itertools import islice
+from multiprocessing import Pool
 
 from app import app
 
 
+def _init_parse_worker():
+    '''
+    parse_manyのworkerの初期化。MeCab.Taggerを先に読み込んでおく
+    '''
+    Wakati().tagger()
+
+
+def _parse_worker(doc):
+    return Wakati().parse(doc)
+
+
 class Wakati():
     '''
     MeCabを使った分かち書き
@@ -15,51 +29,117 @@ class Wakati():
     https://github.com/neologd/mecab-ipadic-neologd/wiki/Regexp.ja
     '''
 
+    # MeCab.Taggerは作る度に辞書を読み込むので、スレッドごとに1つだけ作って使い回す
+    # gunicornのpreload_appでmasterが作ったものは、workerがそのまま引き継ぐ
+    _local = threading.local()
+
+    # 分かち書きの対象にしない品詞たち
+    _EXCLUDED_POS = ('非自立', '接尾', '代名詞', '数')
+    # tokensで使う。key: 品詞の先頭4つ+',' e.g. '名詞,一般,*,*,', value: 分かち書きに含めるか
+    _pos_prefixes = {}
+    # key: MeCabのposid, value: tuple (最初に見た品詞の先頭4つ+',', 分かち書きに含めるか)
+    _posids = {}
+
+    # REMOVE_WORDSをcompileしたもの。remove_remove_wordsの初回に作る
+    _remove_words_patterns = None
+
+    # 正規化で使う正規表現と変換表。呼び出す度に作らないよう、ここで1度だけ作る
+    _NUMERIC_PATTERN = re.compile(
+        '[0-9０-９一二三四五六七八九十壱弐参拾百千万萬億兆〇]+')
+    _FULLWIDTH_PATTERN = re.compile('[０-９Ａ-Ｚａ-ｚ｡-ﾟ]+')
+    # '－'は続いていても1文字ずつ'-'にする
+    _HYPHEN_PATTERN = re.compile('[˗֊‐‑‒–⁃⁻₋−]+|－')
+    _CHOONPU_PATTERN = re.compile('[﹣ｰ—―─━ー]+')
+    _TILDE_PATTERN = re.compile('[~∼∾〜〰～]')
+    # str.translateは1文字ずつ変換表を引くので、変換する文字がある部分だけに使う
+    _HALFWIDTH_SYMBOLS = '!"#$%&\'()*+,-./:;<=>?@[¥]^_`{|}~｡､･｢｣'
+    _FULLWIDTH_SYMBOLS = \
+        '！”＃＄％＆’（）＊＋，－．／：；＜＝＞？＠［￥］＾＿｀｛｜｝〜。、・「」'
+    _FULLWIDTH_TABLE = str.maketrans(_HALFWIDTH_SYMBOLS, _FULLWIDTH_SYMBOLS)
+    _FULLWIDTH_TABLE_PATTERN = re.compile(
+        '[{0}]+'.format(re.escape(_HALFWIDTH_SYMBOLS)))
+    # ＝,・,「,」は全角のままにする
+    _HALFWIDTH_TABLE = str.maketrans(dict(
+        {c: unicodedata.normalize('NFKC', c)
+         for c in '！”＃＄％＆’（）＊＋，－．／：；＜＞？＠［￥］＾＿｀｛｜｝〜'},
+        **{'’': '\'', '”': '"'}
+    ))
+    _HALFWIDTH_TABLE_PATTERN = re.compile(
+        '[{0}]+'.format(re.escape(''.join(map(chr, _HALFWIDTH_TABLE)))))
+    _SPACES_PATTERN = re.compile('[ 　]+')
+    _BLOCKS = ''.join(('\u4E00-\u9FFF',  # CJK UNIFIED IDEOGRAPHS
+                       '\u3040-\u309F',  # HIRAGANA
+                       '\u30A0-\u30FF',  # KATAKANA
+                       '\u3000-\u303F',  # CJK SYMBOLS AND PUNCTUATION
+                       '\uFF00-\uFFEF'   # HALFWIDTH AND FULLWIDTH FORMS
+                       ))
+    _BASIC_LATIN = '\u0000-\u007F'
+    # 日本語どうし、日本語と英数字の間の空白
+    # 空白から始めると、空白がない部分を速く読み飛ばせる
+    _SPACE_BETWEEN_PATTERN = re.compile(
+        ' (?:(?<=[{0}] )(?=[{0}{1}])|(?<=[{1}] )(?=[{0}]))'.format(
+            _BLOCKS, _BASIC_LATIN))
+
     def __init__(self):
         # ハッシュタグまで探すことができる。
         # e.g. https://www.google.com?id=1&name=taro#page2
         self.url_pattern = \
             app.config['URL_PATTERN']
 
-    def _unicode_normalize(self, cls, s):
-        pt = re.compile('([{}]+)'.format(cls))
+    def tagger(self):
+        '''
+        このスレッドのMeCab.Taggerを返す。なければ作る
+        @return MeCab.Tagger
+        '''
+        tagger = getattr(self._local, 'tagger', None)
+        if tagger is None:
+            # -Ochasenを指定するとtabで区切られる。こんな感じ。
+            # ['C言語\tシーゲンゴ\tC言語\t名詞-固有名詞-一般\t\t']
+            tagger = MeCab.Tagger(
+                '-Ochasen -d {0}'.format(app.config['NEOLOGD_PATH']))
+            # mecab-python3の0.7系では、parseを1度呼ばないとparseToNodeの
+            # node.surfaceが壊れた文字列や空文字になる
+            tagger.parse('')
+            self._local.tagger = tagger
+
+        return tagger
+
+    def _unicode_normalize(self, s):
+        '''
+        全角英数字と半角カナをNFKCで正規化する
+        半角カナは濁点と合わせて1文字にするので、1文字ずつではなく続いている部分ごとに行う
+        '''
+        return self._FULLWIDTH_PATTERN.sub(
+            lambda m: unicodedata.normalize('NFKC', m.group()), s)
 
-        def norm(c):
-            return unicodedata.normalize('NFKC', c) if pt.match(c) else c
+    def _normalize_dashes(self, s):
+        '''
+        ハイフンとマイナスを'-'に、長音記号を'ー'にし、チルダを取り除く
+        '''
+        s = self._HYPHEN_PATTERN.sub('-', s)
+        s = self._CHOONPU_PATTERN.sub('ー', s)
+        return self._TILDE_PATTERN.sub('', s)
 
-        s = ''.join(norm(x) for x in re.split(pt, s))
-        s = re.sub('－', '-', s)
-        return s
+    def _translate(self, pattern, table, s):
+        '''
+        patternに一致する部分だけをstr.translateで変換する
+        '''
+        return pattern.sub(lambda m: m.group().translate(table), s)
 
     def _remove_extra_spaces(self, s):
-        s = re.sub('[ 　]+', ' ', s)
-        blocks = ''.join(('\u4E00-\u9FFF',  # CJK UNIFIED IDEOGRAPHS
-                          '\u3040-\u309F',  # HIRAGANA
-                          '\u30A0-\u30FF',  # KATAKANA
-                          '\u3000-\u303F',  # CJK SYMBOLS AND PUNCTUATION
-                          '\uFF00-\uFFEF'   # HALFWIDTH AND FULLWIDTH FORMS
-                          ))
-        basic_latin = '\u0000-\u007F'
-
-        def remove_space_between(cls1, cls2, s):
-            p = re.compile('([{}]) ([{}])'.format(cls1, cls2))
-            while p.search(s):
-                s = p.sub(r'\1\2', s)
-            return s
-
-        s = remove_space_between(blocks, blocks, s)
-        s = remove_space_between(blocks, basic_latin, s)
-        s = remove_space_between(basic_latin, blocks, s)
-        return s
+        '''
+        続いている空白を1つにし、日本語の文字の隣にある空白を取り除く
+        空白の前後の文字だけで決まるので、1回で済む
+        '''
+        s = self._SPACES_PATTERN.sub(' ', s)
+        return self._SPACE_BETWEEN_PATTERN.sub('', s)
 
     def _remove_numeric(self, s):
         '''
         文から数字を取り除く。数字が文の類似度に関係していないという推測の元、取り除く
         _unicode_normalizeが全角を半角にするので、そのあとに実行すること
         '''
-        s = re.sub('[0-9０-９]', '', s)
-        s = re.sub('[一二三四五六七八九十壱弐参拾百千万萬億兆〇]+', '', s)
-        return s
+        return self._NUMERIC_PATTERN.sub('', s)
 
     def _convert_url(self, s):
         '''
@@ -77,12 +157,62 @@ class Wakati():
 
         return s
 
-    def remove_remove_words(self, s):
-        # Read remove words
-        app.config.from_object('config.Words')
+    @classmethod
+    def _compile_remove_words(cls, words):
+        '''
+        REMOVE_WORDSを、先頭から順にre.subした場合と同じ結果になる形にする
+        語を消すと前後がつながって後の語に一致することがあるので、順番は変えない
+        (e.g. '書き手の設定なし'は'設定なし'が先にあるので'書き手の'が残る)
+        - 空白(\\s)はstr.splitと同じ文字なので、split >> joinで消す
+        - 正規表現はcompileしておく
+        - 文字列はstr.replaceで消す。re.subと同じく左から重ならないように置き換える
+          語に含まれる文字の集合も持っておき、元の文字列にない文字を含む語は飛ばす
+        1回の走査でまとめて消すと順に消した場合と結果が変わるので、1語ずつの走査は
+        残っている。REMOVE_WORDSを多く含む10,000文字の文字列では、1語ずつre.subする
+        場合の約1.7倍の速さにしかならない。Benchmark.remove_wordsで計測する
+        @param list words
+        @return list of tuple
+            (None, None) 空白, (re.Pattern, None) 正規表現, (string, frozenset) 文字列
+        '''
+        metachars = set('.^$*+?{}[]\\|()')
+
+        compiled = []
+        for word in words:
+            if word == r'\s':
+                compiled.append((None, None))
+            # '\?'のように記号をescapeしているだけであれば文字列として扱う
+            elif metachars & set(re.sub(r'\\\W', '', word)):
+                compiled.append((re.compile(word), None))
+            else:
+                literal = re.sub(r'\\(\W)', r'\1', word)
+                compiled.append((literal, frozenset(literal)))
 
-        for word in app.config['REMOVE_WORDS']:
-            s = re.sub(word, '', s)
+        return compiled
+
+    def remove_remove_words(self, s):
+        '''
+        config.WordsのREMOVE_WORDSを取り除く
+        REMOVE_WORDSは初回だけ変換し、以降は使い回す
+        @param string s
+        @return string
+        '''
+        patterns = Wakati._remove_words_patterns
+        if patterns is None:
+            from config import Words
+            patterns = self._compile_remove_words(Words.REMOVE_WORDS)
+            Wakati._remove_words_patterns = patterns
+
+        # 消すことで文字が増えることはないので、元の文字列にない文字を含む語は
+        # 途中でも一致しない
+        chars = set(s)
+
+        for word, need in patterns:
+            if word is None:
+                s = ''.join(s.split())
+            elif need is None:
+                s = word.sub('', s)
+            elif need <= chars:
+                s = s.replace(word, '')
         return s
 
     def _normalize_neologd(self, s):
@@ -92,78 +222,146 @@ class Wakati():
         s = self._convert_url(s)
         s = self.remove_remove_words(s)
         s = self._remove_numeric(s)
-
-        s = self._unicode_normalize('０-９Ａ-Ｚａ-ｚ｡-ﾟ', s)
-
-        def maketrans(f, t):
-            return {ord(x): ord(y) for x, y in zip(f, t)}
-
-        s = re.sub('[˗֊‐‑‒–⁃⁻₋−]+', '-', s)  # normalize hyphens
-        s = re.sub('[﹣－ｰ—―─━ー]+', 'ー', s)  # normalize choonpus
-        s = re.sub('[~∼∾〜〰～]', '', s)  # remove tildes
-        s = s.translate(
-            maketrans(
-                '!"#$%&\'()*+,-./:;<=>?@[¥]^_`{|}~｡､･｢｣',
-                '！”＃＄％＆’（）＊＋，－．／：；＜＝＞？＠［￥］＾＿｀｛｜｝〜。、・「」'
-            )
-        )
-
+        s = self._unicode_normalize(s)
+        s = self._normalize_dashes(s)
+        s = self._translate(
+            self._FULLWIDTH_TABLE_PATTERN, self._FULLWIDTH_TABLE, s)
         s = self._remove_extra_spaces(s)
         # keep ＝,・,「,」
-        s = self._unicode_normalize(
-            '！”＃＄％＆’（）＊＋，－．／：；＜＞？＠［￥］＾＿｀｛｜｝〜',
-            s
-        )
-        s = re.sub('[’]', '\'', s)
-        s = re.sub('[”]', '"', s)
+        s = self._translate(
+            self._HALFWIDTH_TABLE_PATTERN, self._HALFWIDTH_TABLE, s)
 
         return s
 
-    def parse(self, doc):
+    def normalize(self, doc):
         '''
-        日本語を分かち書きにするためのメソッド
-        動詞と名詞の基本形だけを抜き出す
+        parseの前に行う正規化だけを実行する
+        正規化した文字列が同じであれば、parseの結果も同じになる
         @param string doc
-        @return string 分かち書きにしたdocumentを返す
+        @return string
         '''
-
         if not doc:
             return ''
 
-        # -Ochasenを指定するとtabで区切られる。こんな感じ。
-        # ['C言語\tシーゲンゴ\tC言語\t名詞-固有名詞-一般\t\t']
-        tagger = MeCab.Tagger(
-            '-Ochasen -d {0}'.format(os.path.expanduser('~') + '/mecab-ipadic-neologd/mecab-ipadic-neologd')
-        )
+        return self._normalize_neologd(doc)
 
-        # 正規化した上で分形態素解析して、1行ごとに区切ってリスト化する
-        words = tagger.parse(self._normalize_neologd(doc)).split('\n')
+    def _is_target_pos(self, feature):
+        '''
+        品詞から、分かち書きに含めるかを判定する
+        @param string feature MeCabのnode.feature
+            e.g. '名詞,固有名詞,一般,*,*,*,C言語,シーゲンゴ,シーゲンゴ'
+        @return bool
+        '''
+        # -Ochasenの品詞と同じく、'*'以外を並べる。e.g. ['名詞', '固有名詞', '一般']
+        part = [p for p in feature.split(',', 4)[:4] if p != '*']
 
-        # 対象にしない品詞たち
-        parts = ['非自立', '接尾', '代名詞', '数']
+        if part[-1] in self._EXCLUDED_POS:
+            return False
 
-        val = []
-        for word in words:
-            # EOS, ''の場合は無視
-            if word == 'EOS' or word == '':
-                continue
+        if len(part) >= 3 and part[-2] in self._EXCLUDED_POS:
+            return False
 
-            # タブで区切り、リスト化
-            word_info = word.split('\t')
+        return part[0] == '名詞'
 
-            # word_info[3]に品詞が格納されている
-            part = word_info[3].split('-')
+    def tokens(self, doc, normalized=False):
+        '''
+        日本語を分かち書きにし、名詞の基本形をリストで返す
+        MeCabのnodeを順にたどり、品詞(featureの先頭4つ)ごとの判定結果はキャッシュする。
+        posidごとに最初に見た品詞も持っておき、featureがそれで始まっていれば
+        品詞の文字列を分けずに判定結果を使う
+        @param string doc
+        @param bool normalized docがnormalize済みであればTrue
+        @return list of string
+        '''
+        if not doc:
+            return []
 
-            if part[-1] in parts:
-                continue
+        if not normalized:
+            doc = self._normalize_neologd(doc)
 
-            if len(part) >= 3:
-                if part[-2] in parts:
-                    continue
+        posids = self._posids
+        prefixes = self._pos_prefixes
+        val = []
 
-            if part[0] in ['名詞']:
-                # 3番目に基本形が格納されている
-                val.append(word_info[2])
+        node = self.tagger().parseToNode(doc)
+        while node:
+            # BOS/EOSは飛ばす
+            if node.stat in (MeCab.MECAB_BOS_NODE, MeCab.MECAB_EOS_NODE):
+                node = node.next
+                continue
 
+            # posidは辞書にpos-id.defがないと全て同じ値になるので、そのまま信用はせず、
+            # 最初に見た品詞と前方一致することを確認してから判定結果を使う
+            feature = node.feature
+            cached = posids.get(node.posid)
+            if cached is not None and feature.startswith(cached[0]):
+                target = cached[1]
+            else:
+                pos = ','.join(feature.split(',', 4)[:4]) + ','
+                target = prefixes.get(pos)
+                if target is None:
+                    target = self._is_target_pos(feature)
+                    prefixes[pos] = target
+                if cached is None:
+                    posids[node.posid] = (pos, target)
+
+            if target:
+                if node.stat == MeCab.MECAB_UNK_NODE:
+                    # 未知語は基本形がないので、-Ochasenと同じく表層形にする
+                    val.append(node.surface)
+                else:
+                    # 7番目に基本形が格納されている
+                    val.append(feature.split(',', 7)[6])
+
+            node = node.next
+
+        return val
+
+    def parse(self, doc, normalized=False):
+        '''
+        日本語を分かち書きにするためのメソッド
+        名詞の基本形だけを抜き出す。tokensの結果を空白でつなげたもの
+        @param string doc
+        @param bool normalized docがnormalize済みであればTrue
+        @return string 分かち書きにしたdocumentを返す
+        '''
         # ホワイトスペースでつなげて1つの文字列にする
-        return ' '.join(val)
+        return ' '.join(self.tokens(doc, normalized=normalized))
+
+    def parse_many(self, docs, processes=None):
+        '''
+        複数のdocumentをまとめて分かち書きにする
+        POOL_PROCESS_NUMのプロセスで並列に実行し、docsと同じ順で返す。
+        docsは少しずつ読み込むので、generatorを渡せば全件をメモリに載せずに済む
+        @param iterable docs
+        @param int processes 省略した場合はPOOL_PROCESS_NUM
+        @return generator string
+        '''
+        if processes is None:
+            processes = app.config['POOL_PROCESS_NUM']
+
+        docs = iter(docs)
+
+        if processes <= 1:
+            for doc in docs:
+                yield self.parse(doc)
+            return
+
+        chunksize = app.config['PARSE_MANY_CHUNK_SIZE']
+        # Pool.imapはdocsを全て読み込んでしまうので、この件数ずつ渡す
+        window = processes * chunksize * app.config['PARSE_MANY_PREFETCH']
+
+        with Pool(processes=processes, initializer=_init_parse_worker) as pool:
+            pending = None
+            while True:
+                # 前の分を返している間に、次の分を分かち書きしておく
+                chunk = list(islice(docs, window))
+                results = pool.imap(_parse_worker, chunk, chunksize) \
+                    if chunk else None
+
+                if pending is not None:
+                    yield from pending
+
+                if results is None:
+                    break
+                pending = results
@@ -5,19 +5,25 @@ import sys
 import mysql.connector
 from flask import abort
 
+from app.utility.executor import Executor
+
 
 class Connect():
     '''
     MYSQLとの接続に関する処理
     '''
 
-    def __init__(self, role='master'):
+    def __init__(self, role='master', buffered=True):
         '''
         @param str role
             You can set 'master' or 'slave'
             Default is 'master'
+        @param bool buffered
+            Falseにすると、結果をfetchした分だけ読み込む。
+            全件読み込むまで同じ接続で別のクエリーは実行できない
         '''
         self.role = role
+        self.buffered = buffered
 
     def open(self):
         ''''''
@@ -29,7 +35,7 @@ class Connect():
                 'host': os.getenv('MYSQL_MASTER_HOSTNAME'),
                 'port': os.getenv('MYSQL_MASTER_PORT'),
                 'database': os.getenv('MYSQL_MASTER_DATABASE'),
-                'buffered': True,
+                'buffered': self.buffered,
             }
         elif self.role == 'slave':
             mysql_config = {
@@ -38,7 +44,7 @@ class Connect():
                 'host': os.getenv('MYSQL_READ_HOSTNAME'),
                 'port': os.getenv('MYSQL_READ_PORT'),
                 'database': os.getenv('MYSQL_READ_DATABASE'),
-                'buffered': True,
+                'buffered': self.buffered,
                 # 時間のかかるSQLもこのtimeoutの対象になるので、設定しなくてよい
                 # 'connection_timeout': 3
             }
@@ -49,9 +55,14 @@ class Connect():
                 'host': os.getenv('MYSQL_MASTER_HOSTNAME'),
                 'port': os.getenv('MYSQL_MASTER_PORT'),
                 'database': os.getenv('MYSQL_MASTER_DATABASE'),
-                'buffered': True,
+                'buffered': self.buffered,
             }
 
+        # C拡張はgeventのpatchの対象外で、通信中にworker全体が止まってしまうので
+        # geventでsocketがpatchされている場合だけpure pythonの実装を使う
+        # syncのworkerやバッチでは速いC拡張を使う
+        mysql_config['use_pure'] = Executor.cooperative()
+
         try:
             # connectに直接configの中身を渡すとエラーになる。
             # mysqlはredisと違ってこの時点で接続できる否かを判別する
@@ -1,6 +1,9 @@
 # coding: utf-8
 
+import os
 import re
+import threading
+import time
 import pytz
 from datetime import datetime, timedelta
 
@@ -104,6 +107,36 @@ class MessageSpams():
 
         return self.m.lastrowid
 
+    def create_many(self, rows):
+        '''
+        複数のレコードを1回のINSERTでまとめて作成し、1回だけcommitする
+        キューに戻されて同じmessageを再度処理した場合も2重に作成しないように、
+        message_idが既に存在すればscore, predict, biz_filterを更新する
+        @param list of tuple rows
+            (board_id, message_id, score, predict, biz_filter)
+        @return int 影響を受けた行数
+        '''
+        if not rows:
+            return 0
+
+        query = ('''
+            INSERT INTO message_spams
+            (created, modified, board_id, message_id, score, predict, biz_filter)
+            VALUES
+            {0}
+            ON DUPLICATE KEY UPDATE
+            modified = NOW(),
+            score = VALUES(score),
+            predict = VALUES(predict),
+            biz_filter = VALUES(biz_filter)
+        '''.format(', '.join(
+            ['(NOW(), NOW(), %s, %s, %s, %s, %s)'] * len(rows))))
+
+        self.m.execute(query, [val for row in rows for val in row])
+        self.con.commit()
+
+        return self.m.rowcount
+
     def list_with_board_id(self, board_id):
         '''
         特定のboard_idの全てのmessagesを全て取得する
@@ -317,3 +350,128 @@ class MessageSpams():
         self.con.commit()
 
         return self.m.lastrowid
+
+
+class _Row():
+    '''
+    MessageSpamsWriterに渡された1行分の値と、書き込みの結果
+    '''
+
+    def __init__(self, args):
+        self.args = args
+        self.enqueued = time.monotonic()
+        self.event = threading.Event()
+        self.error = None
+
+
+class MessageSpamsWriter():
+    '''
+    message_spamsへのINSERTをまとめて書き込む
+    1件ごとに接続してINSERTとcommitをすると、キューが溜まっている時に
+    masterへの接続とcommitがボトルネックになるので、
+    最大MESSAGE_SPAMS_WRITE_SIZE件、最初の1件からMESSAGE_SPAMS_WRITE_WAIT_MSミリ秒までの
+    行をまとめて、開きっぱなしの接続からcreate_manyで書き込む
+    '''
+
+    # key: pid, value: MessageSpamsWriter
+    _writers = {}
+    _lock = threading.Lock()
+
+    def __init__(self):
+        '''
+        直接インスタンスを作らず、MessageSpamsWriter.get()を使うこと
+        '''
+        self.size = app.config['MESSAGE_SPAMS_WRITE_SIZE']
+        self.wait = app.config['MESSAGE_SPAMS_WRITE_WAIT_MS'] / 1000
+        self.ms = None
+
+        self._pending = []
+        self._cond = threading.Condition()
+
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @classmethod
+    def get(cls):
+        '''
+        プロセス内で共有するMessageSpamsWriterを返す
+        @return MessageSpamsWriter
+        '''
+        # forkしたworkerにmasterのスレッドと接続は引き継がれないので、プロセスごとに作る
+        pid = os.getpid()
+
+        with cls._lock:
+            if pid not in cls._writers:
+                cls._writers[pid] = cls()
+
+        return cls._writers[pid]
+
+    def write(self, args, wait=True):
+        '''
+        @param tuple args (board_id, message_id, score, predict, biz_filter)
+        @param bool wait
+            Trueであればcommitされるまで待ち、失敗した場合は例外を投げる
+            Falseであれば待たない。失敗した場合はログに残すだけ
+        '''
+        row = _Row(args)
+
+        with self._cond:
+            self._pending.append(row)
+            self._cond.notify()
+
+        if not wait:
+            return
+
+        row.event.wait()
+
+        if row.error is not None:
+            raise row.error
+
+    def _take(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+
+            deadline = self._pending[0].enqueued + self.wait
+            while len(self._pending) < self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            rows = self._pending[:self.size]
+            del self._pending[:self.size]
+
+        return rows
+
+    def _flush(self, rows):
+        # 接続は開いたまま使い回す。失敗した場合は閉じて、次回開き直す
+        if self.ms is None:
+            self.ms = MessageSpams().__enter__()
+
+        try:
+            self.ms.create_many([row.args for row in rows])
+        except Exception:
+            try:
+                self.ms.con.close()
+            except Exception:
+                pass
+            self.ms = None
+            raise
+
+    def _loop(self):
+        while True:
+            rows = self._take()
+
+            try:
+                self._flush(rows)
+            except Exception as e:
+                app.sentry.captureException(str(e))
+                app.logger.error(
+                    'MessageSpams bulk write is failed. Reason: {0}'.format(e))
+                for row in rows:
+                    row.error = e
+
+            for row in rows:
+                row.event.set()
@@ -12,11 +12,17 @@ class Messages():
     コンテキストマネージャで呼び出すこと。
     '''
 
-    def __init__(self, role='master'):
+    def __init__(self, role='master', buffered=True):
+        '''
+        @param string role
+        @param bool buffered
+            iter_*で全件をメモリに載せずに読み込む場合はFalseにする
+        '''
         self.role = role
+        self.buffered = buffered
 
     def __enter__(self):
-        self.con = Connect(role=self.role)
+        self.con = Connect(role=self.role, buffered=self.buffered)
         self.m = self.con.open()
         return self
 
@@ -152,6 +158,72 @@ class Messages():
         self.m.execute(query)
         return self.m.fetchall()
 
+    def _stream(self, query, size):
+        '''
+        クエリーを実行し、結果をsize件ずつfetchmanyで読み込む
+        buffered=Falseの場合、読み込みが止まっている間はMySQLが送信を待つので、
+        net_write_timeoutを分かち書きや重複チェックにかかる時間より長くしておく
+        @param string query
+        @param int size
+        @return generator of dict
+        '''
+        self.m.execute('SET SESSION net_write_timeout = {0}'.format(
+            int(app.config['MYSQL_NET_WRITE_TIMEOUT'])))
+        self.m.execute(query)
+
+        return self._fetch_iter(size)
+
+    def _fetch_iter(self, size):
+        '''
+        実行済みのクエリーの結果をsize件ずつfetchmanyで読み込む
+        @param int size
+        @return generator of dict
+        '''
+        while True:
+            rows = self.m.fetchmany(size)
+            if not rows:
+                break
+
+            for row in rows:
+                yield row
+
+    def iter_pos(self, after_this_id=None, min_datetime=None, size=1000):
+        '''
+        get_posと同じ条件のmessagesを、size件ずつ読み込む
+        呼び出し側でboardごとにまとめられるように、board_id, idの順に並べる
+        @param int after_this_id 指定した場合は、このidより後のmessageだけを取得する
+        @param string min_datetime after_this_idがない場合に使う作成日時の下限
+        @param int size fetchmanyで1度に読み込む件数
+        @return generator of dict
+          e.g. {'id': 391778, 'board_id': 1234, 'description': b'...'}
+        '''
+
+        min_datetime = min_datetime or '2017-02-01 00:00:00'
+        if after_this_id:
+            condition = 'Message.id > {0}'.format(int(after_this_id))
+        else:
+            condition = "Message.created >= '{0}'".format(min_datetime)
+
+        query = ('''
+            SELECT
+            Message.id,
+            Message.board_id,
+            Message.description
+            FROM messages as Message
+            INNER JOIN users as User on Message.user_id = User.id
+            INNER JOIN boards as Board on Board.id = Message.board_id
+            WHERE
+            User.status = "blacked" AND
+            Message.user_id = Board.owner_id AND
+            Message.description != 'send file' AND
+            Message.description != '' AND
+            Message.description IS NOT NULL AND
+            {0}
+            order by Message.board_id asc, Message.id asc
+        '''.format(condition))
+
+        return self._stream(query, size)
+
     def get_neg(self, min_datetime=None, max_datetime=None):
         '''
         クライアントユーザの不正ではないmessagesを取得
@@ -12,11 +12,17 @@ class Works():
     コンテキストマネージャで呼び出すこと。
     '''
 
-    def __init__(self, role='master'):
+    def __init__(self, role='master', buffered=True):
+        '''
+        @param string role
+        @param bool buffered
+            iter_*で全件をメモリに載せずに読み込む場合はFalseにする
+        '''
         self.role = role
+        self.buffered = buffered
 
     def __enter__(self):
-        self.con = Connect(role=self.role)
+        self.con = Connect(role=self.role, buffered=self.buffered)
         self.m = self.con.open()
         return self
 
@@ -219,6 +225,69 @@ class Works():
         self.m.execute(query)
         return self.m.fetchall()
 
+    def _stream(self, query, size):
+        '''
+        クエリーを実行し、結果をsize件ずつfetchmanyで読み込む
+        buffered=Falseの場合、読み込みが止まっている間はMySQLが送信を待つので、
+        net_write_timeoutを分かち書きや重複チェックにかかる時間より長くしておく
+        @param string query
+        @param int size
+        @return generator of dict
+        '''
+        self.m.execute('SET SESSION net_write_timeout = {0}'.format(
+            int(app.config['MYSQL_NET_WRITE_TIMEOUT'])))
+        self.m.execute(query)
+
+        return self._fetch_iter(size)
+
+    def _fetch_iter(self, size):
+        '''
+        実行済みのクエリーの結果をsize件ずつfetchmanyで読み込む
+        @param int size
+        @return generator of dict
+        '''
+        while True:
+            rows = self.m.fetchmany(size)
+            if not rows:
+                break
+
+            for row in rows:
+                yield row
+
+    def iter_pos(self, after_this_id=None, min_datetime=None, size=1000):
+        '''
+        get_posと同じ条件のworkを、idの昇順にsize件ずつ読み込む
+        buffered=Falseで開いた場合は、全件をメモリに載せずに処理できる
+        @param int after_this_id 指定した場合は、このidより後のworkだけを取得する
+        @param string min_datetime after_this_idがない場合に使う作成日時の下限
+        @param int size fetchmanyで1度に読み込む件数
+        @return generator of dict
+          e.g. {'id': 391778, 'title': b'...', 'description': b'...'}
+        '''
+
+        # get_posと同じ理由で2017-02-01 00:00:00以降のデータのみを対象とする
+        min_datetime = min_datetime or '2017-02-01 00:00:00'
+        if after_this_id:
+            condition = 'Work.id > {0}'.format(int(after_this_id))
+        else:
+            condition = "Work.created >= '{0}'".format(min_datetime)
+
+        query = ('''
+            SELECT
+            Work.id,
+            Work.title,
+            Work.description
+            FROM works as Work
+            INNER JOIN users on Work.user_id = users.id
+            WHERE
+            users.status = "blacked" AND
+            Work.type = 'project' AND
+            {0}
+            order by Work.id asc
+        '''.format(condition))
+
+        return self._stream(query, size)
+
     def get_neg(self, max_datetime=None, min_datetime=None):
         '''
         クライアントが作った良質なworkをmlmのnegativeとする
@@ -320,6 +389,41 @@ class Works():
         self.m.execute(query)
         return self.m.fetchall()
 
+    def iter_vl_pos(self, after_this_id=None, min_datetime=None, size=1000,
+                    work_type='project'):
+        '''
+        _get_vl_posと同じ条件のworkを、idの昇順にsize件ずつ読み込む
+        @param int after_this_id 指定した場合は、このidより後のworkだけを取得する
+        @param string min_datetime after_this_idがない場合に使う作成日時の下限
+        @param int size fetchmanyで1度に読み込む件数
+        @param string work_type
+        @return generator of dict
+          e.g. {'id': 391778, 'title': b'...', 'description': b'...'}
+        '''
+
+        min_datetime = min_datetime or '2016-10-01 00:00:00'
+        if after_this_id:
+            condition = 'Work.id > {0}'.format(int(after_this_id))
+        else:
+            condition = "Work.created >= '{0}'".format(min_datetime)
+
+        query = ('''
+            SELECT
+            Work.id,
+            Work.title,
+            Work.description
+            FROM works AS Work
+            INNER JOIN users on Work.user_id = users.id
+            WHERE
+            users.status != "blacked" AND
+            Work.violation_status = 'other' AND
+            Work.type = '{1}' AND
+            {0}
+            order by Work.id asc
+        '''.format(condition, work_type))
+
+        return self._stream(query, size)
+
     def _get_vl_neg(self, max_datetime=None, min_datetime=None):
         '''
         Negative data for violation
@@ -9,8 +9,14 @@ import fakeredis
 class Connect():
     '''
     Redisとの接続に関する処理
+    コネクションプールはプロセスごとに1つずつ持つ。
+    gunicornのpreload_appでforkした場合も、masterの接続を使い回さないように
+    pidが変わればプールを作り直す
     '''
 
+    # key: (pid, host, role, decode_responses), value: ConnectionPool
+    _pools = {}
+
     def __init__(self, host='api', role='master', decode_responses=True):
         '''
         @param str host
@@ -64,17 +70,30 @@ class Connect():
                     port = os.getenv('REDIS_API_MASTER_PORT', 6379)
                     db = os.getenv('REDIS_API_MASTER_DB', 0)
 
-            self.r = redis.StrictRedis(
-                host=host,
-                password=password,
-                port=port,
-                db=db,
-                decode_responses=self.decode_responses,
-                socket_timeout=60
-            )
+            key = (os.getpid(), self.host, self.role, self.decode_responses)
+            if key not in self._pools:
+                Connect._pools[key] = redis.ConnectionPool(
+                    host=host,
+                    password=password,
+                    port=port,
+                    db=db,
+                    decode_responses=self.decode_responses,
+                    socket_timeout=60
+                )
+
+            self.r = redis.StrictRedis(connection_pool=self._pools[key])
 
             return self.r
 
+    @classmethod
+    def reset(cls):
+        '''
+        プールを全て破棄する。fork直後に呼び出すこと
+        masterと共有しているソケットを閉じてしまわないように、
+        disconnectはせずに参照だけを外す
+        '''
+        cls._pools = {}
+
     def is_connect(self):
         '''
         Check Redis Connection
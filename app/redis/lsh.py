@@ -0,0 +1,159 @@
+# coding: utf-8
+
+from app import app
+from app.ml.minhash import MinHash
+from app.redis.connect import Connect
+
+
+class LSHIndex():
+    '''
+    DATASETS_*のhashに対応する、MinHash/LSHの近似重複のindex
+    hashと同じRedisに保存し、hashに追加・削除する度に更新する。
+    重複の候補は、bandの数だけのSMEMBERSを1回の通信で取得すれば分かるので、
+    hashを全件取得して比較する必要がない
+
+    - DATASETS_LSH: bandごとのbucketのset。値はhashのid
+    - DATASETS_LSH_BUCKETS: hash。key: id, value: そのidのbucketを','でつなげたもの
+      削除する時に、どのbucketから消せばよいかを知るために使う
+
+    OVERLAP_SHINGLE_SIZE, OVERLAP_LSH_BANDS, OVERLAP_LSH_ROWSを変えた場合はrebuildすること
+    '''
+
+    def __init__(self, key_name, host=None, role='master'):
+        '''
+        @param string key_name DATASETS_*のキー
+        @param string host Connectのhost
+        @param string role
+            追加した直後の値を参照できるように、デフォルトではmasterから読み込む
+        '''
+        self.key_name = key_name
+        self.host = host
+        self.role = role
+        self.minhash = MinHash()
+        self.buckets_key = app.config['DATASETS_LSH_BUCKETS'].format(key_name)
+
+    def _open(self):
+        if self.host:
+            return Connect(host=self.host, role=self.role).open()
+        return Connect(role=self.role).open()
+
+    def _bucket_key(self, band, bucket):
+        return app.config['DATASETS_LSH'].format(self.key_name, band, bucket)
+
+    def buckets(self, body):
+        '''
+        @param string body 分かち書きの文字列
+        @return list of string
+        '''
+        return self.minhash.buckets(self.minhash.signature(body))
+
+    def exists(self):
+        '''
+        indexがhashと同じ件数だけあるか
+        件数が異なる場合は、rebuildで作り直すこと
+        @return bool
+        '''
+        r = self._open()
+        with r.pipeline(transaction=False) as pipe:
+            pipe.hlen(self.key_name)
+            pipe.hlen(self.buckets_key)
+            count, indexed = pipe.execute()
+
+        return count == indexed
+
+    def query(self, body):
+        '''
+        いずれかのbandでbucketが一致するid
+        実際に重複しているかは呼び出し側で確認すること
+        @param string body 分かち書きの文字列
+        @return set of string
+        '''
+        r = self._open()
+        with r.pipeline(transaction=False) as pipe:
+            for band, bucket in enumerate(self.buckets(body)):
+                pipe.smembers(self._bucket_key(band, bucket))
+            members = pipe.execute()
+
+        return set().union(*members)
+
+    def add(self, obj_id, body, pipe=None):
+        '''
+        @param string obj_id
+        @param string body 分かち書きの文字列
+        @param Pipeline pipe
+            渡された場合はpipeに積むだけで、executeは呼び出し側で行う
+        '''
+        buckets = self.buckets(body)
+
+        if pipe is None:
+            with self._open().pipeline(transaction=False) as p:
+                self._add(p, obj_id, buckets)
+                p.execute()
+            return
+
+        self._add(pipe, obj_id, buckets)
+
+    def _add(self, pipe, obj_id, buckets):
+        for band, bucket in enumerate(buckets):
+            pipe.sadd(self._bucket_key(band, bucket), obj_id)
+        pipe.hset(self.buckets_key, obj_id, ','.join(buckets))
+
+    def remove(self, *obj_ids):
+        '''
+        hashからhdelしたidを、indexからも削除する
+        @param string obj_ids
+        '''
+        if not obj_ids:
+            return
+
+        r = self._open()
+        saved = r.hmget(self.buckets_key, obj_ids)
+
+        with r.pipeline(transaction=False) as pipe:
+            for obj_id, buckets in zip(obj_ids, saved):
+                if not buckets:
+                    continue
+                for band, bucket in enumerate(buckets.split(',')):
+                    pipe.srem(self._bucket_key(band, bucket), obj_id)
+            pipe.hdel(self.buckets_key, *obj_ids)
+            pipe.execute()
+
+    def clear(self):
+        '''
+        indexを全て削除する
+        '''
+        r = self._open()
+        pattern = app.config['DATASETS_LSH'].format(self.key_name, '*', '*')
+
+        keys = [self.buckets_key]
+        for key in r.scan_iter(match=pattern, count=1000):
+            keys.append(key)
+            if len(keys) >= 1000:
+                r.delete(*keys)
+                keys = []
+
+        if keys:
+            r.delete(*keys)
+
+    def rebuild(self):
+        '''
+        hashの全件からindexを作り直す
+        @return int indexに入れた件数
+        '''
+        self.clear()
+
+        r = self._open()
+        count = 0
+
+        with r.pipeline(transaction=False) as pipe:
+            for obj_id, body in r.hscan_iter(self.key_name, count=1000):
+                self.add(obj_id, body, pipe=pipe)
+                count += 1
+                if count % 1000 == 0:
+                    pipe.execute()
+            pipe.execute()
+
+        app.logger.info('LSH index is rebuilt. key: {0}, count: {1}'.format(
+            self.key_name, count))
+
+        return count
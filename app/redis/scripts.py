@@ -0,0 +1,38 @@
+# coding: utf-8
+
+
+class Scripts():
+    '''
+    複数のコマンドを1回の通信で、他のクライアントに割り込まれずに実行するためのLuaスクリプト
+    Connect().open().register_script()で登録して使う
+    '''
+
+    # キューの先頭からARGV[1]件を取り出し、処理中リストの末尾に移す
+    # KEYS[1]: キュー, KEYS[2]: 処理中リスト, ARGV[1]: 件数
+    # @return list 移した値
+    TAKE = '''
+        local ids = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+        if #ids > 0 then
+            redis.call('LTRIM', KEYS[1], #ids, -1)
+            redis.call('RPUSH', KEYS[2], unpack(ids))
+        end
+        return ids
+    '''
+
+    # 検知済みuserでなければ検知済みにする
+    # KEYS[1]: 検知済みuserのset, KEYS[2]: userごとのキー
+    # ARGV[1]: user_id, ARGV[2]: userごとのキーの有効期限(秒)。0であればsetに追加する
+    # @return int 1: 今回検知済みにした, 0: 既に検知済み
+    CHECK_AND_ADD = '''
+        if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 1 then
+            return 0
+        end
+        local ttl = tonumber(ARGV[2])
+        if ttl > 0 then
+            if redis.call('SET', KEYS[2], 1, 'NX', 'EX', ttl) then
+                return 1
+            end
+            return 0
+        end
+        return redis.call('SADD', KEYS[1], ARGV[1])
+    '''
@@ -5,6 +5,7 @@ import gzip
 
 from app import app
 from app.redis.connect import Connect
+from app.redis.lsh import LSHIndex
 from app.mysql.messages import Messages as Mysql_messages
 
 
@@ -120,6 +121,12 @@ class Backup():
 
             pipe.execute()
 
+        # 復元したhashとindexが合わなくなるので、indexは削除する
+        # Update.runの実行時に作り直される
+        for key in ('DATASETS_PJT_MLM_POS', 'DATASETS_PJT_MLM_NEG',
+                    'DATASETS_MSG_POS', 'DATASETS_MSG_NEG'):
+            LSHIndex(app.config[key], host='api').clear()
+
     def _set(self):
         # MSG_LAST_PULLEDに最新のmessage.idをセットする
         with Mysql_messages(role='slave') as m:
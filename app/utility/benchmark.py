@@ -0,0 +1,125 @@
+# coding: utf-8
+
+import re
+import time
+
+import MeCab
+
+from app import app
+from app.ml.wakati import Wakati
+
+
+class Benchmark():
+    '''
+    処理時間を計測するためのマイクロベンチマーク
+    サーバ上で次のように実行し、改善前後の1回あたりの時間を比較する
+    python -c 'from app.utility.benchmark import Benchmark; Benchmark().tagger()'
+    '''
+
+    DOC = '''はじめまして。突然のご連絡失礼いたします。
+    在宅でできる簡単なお仕事のご紹介です。1日30分の作業で月10万円以上の収入が可能です。
+    詳しくはこちらのURLからLINEの友だち登録をお願いいたします。https://example.com/?id=1'''
+
+    def _measure(self, fn, n):
+        '''
+        @param callable fn
+        @param int n 実行回数
+        @return float 1回あたりのミリ秒
+        '''
+        # 1回目は辞書の読み込み等が入るので計測しない
+        fn()
+
+        started = time.perf_counter()
+        for _ in range(n):
+            fn()
+
+        return (time.perf_counter() - started) * 1000 / n
+
+    def _print(self, name, results):
+        print(name)
+        for label, ms in results:
+            print('  {0}: {1:.3f} ms/call'.format(label, ms))
+
+    def tagger(self, n=100):
+        '''
+        Wakati.parseでMeCab.Taggerを毎回作る場合と、使い回す場合の比較
+        @param int n
+        @return dict
+        '''
+        wakati = Wakati()
+        normalized = wakati.normalize(self.DOC)
+
+        def fresh():
+            MeCab.Tagger(
+                '-Ochasen -d {0}'.format(app.config['NEOLOGD_PATH'])
+            ).parse(normalized)
+
+        def cached():
+            wakati.tagger().parse(normalized)
+
+        results = [
+            ('fresh tagger', self._measure(fresh, n)),
+            ('cached tagger', self._measure(cached, n)),
+            ('Wakati.parse', self._measure(lambda: wakati.parse(self.DOC), n)),
+        ]
+        self._print('tagger', results)
+
+        return dict(results)
+
+    def remove_words(self, n=100, length=10000):
+        '''
+        REMOVE_WORDSを1語ずつre.subする場合と、Wakati.remove_remove_wordsの比較
+        案件の説明文のような長い文字列で計測する。結果が異なる場合は表示する
+        @param int n
+        @param int length 計測に使う文字列の長さ
+        @return dict
+        '''
+        from config import Words
+
+        words = Words.REMOVE_WORDS
+        # REMOVE_WORDSを含む文字列にする
+        sample = ''.join(
+            '{0}{1}'.format(self.DOC, words[i % len(words)].replace('\\', ''))
+            for i in range(length // len(self.DOC) + 1))[:length]
+
+        wakati = Wakati()
+
+        def sequential():
+            s = sample
+            for word in words:
+                s = re.sub(word, '', s)
+            return s
+
+        def compiled():
+            return wakati.remove_remove_words(sample)
+
+        results = [
+            ('sequential re.sub', self._measure(sequential, n)),
+            ('remove_remove_words', self._measure(compiled, n)),
+        ]
+        self._print('remove_words', results)
+
+        if sequential() != compiled():
+            print('  output differs')
+
+        return dict(results)
+
+    def normalize(self, n=100, length=10000):
+        '''
+        Wakati.normalizeの計測。ボードのやりとりのような長い文字列と、
+        空白の多い文字列で計測する
+        @param int n
+        @param int length 計測に使う文字列の長さ
+        @return dict
+        '''
+        wakati = Wakati()
+        sample = (self.DOC * (length // len(self.DOC) + 1))[:length]
+        spaces = ('あ a い b ' * (length // 8 + 1))[:length]
+
+        results = [
+            ('long', self._measure(lambda: wakati.normalize(sample), n)),
+            ('spaces', self._measure(lambda: wakati.normalize(spaces), n)),
+        ]
+        self._print('normalize', results)
+
+        return dict(results)
@@ -0,0 +1,38 @@
+# coding: utf-8
+
+import hashlib
+import math
+
+
+class BloomFilter():
+    '''
+    集合に含まれるかを、少ないメモリで判定する
+    Falseであれば必ず含まれていない。Trueの場合はerrorの確率で誤りがある
+    '''
+
+    def __init__(self, capacity, error):
+        '''
+        @param int capacity 想定する最大件数
+        @param float error capacity件入れた時の誤判定の確率
+        '''
+        self.size = int(math.ceil(
+            -capacity * math.log(error) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # 1回のハッシュを2つに分けて、k個の位置を作る(double hashing)
+        digest = hashlib.md5(str(value).encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for pos in self._positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, value):
+        return all(
+            self.bits[pos >> 3] & (1 << (pos & 7))
+            for pos in self._positions(value))
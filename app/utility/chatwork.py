@@ -41,11 +41,14 @@ class Chatwork():
                 'Chawtwork is_connect is failed. Reason: {0}'.format(e))
             return False
 
-    def _send(self, room_id, body):
+    def send(self, room_id, body):
         '''
+        chatworkにメッセージを送る。Notifierから呼び出す
+        chatworkに接続できない場合はConnectionErrorが発生する
         @param int room_id
         @param string body
-        @return int 正常に完了すれば200が返る。それ以外は500を返すようにしている
+        @return requests.Response
+            X-RateLimit-Remaining, X-RateLimit-Resetヘッダで残りの呼び出し回数がわかる
         '''
 
         url = self.url + 'rooms/{0}/messages'.format(room_id)
@@ -53,42 +56,25 @@ class Chatwork():
             'body': body
         }
 
-        try:
-            res = requests.post(
-                url,
-                headers=self.headers,
-                data=payload
-            )
-            return res.status_code
-        except Exception as e:
-            app.sentry.captureException(str(e))
-            # chatworkに接続できない場合はjsonで1つの文字列にしてキューに入れる
-            # 接続できない場合はConnectionErrorが発生する
-            Connect().open().rpush(
-                app.config['QUEUE_CHATWORK_MSG'],
-                json.dumps({'room_id': room_id, 'body': body}))
-
-            app.logger.error(
-                'Chawtwork _send is failed. Reason: {0}'.format(e))
-            return 500
+        return requests.post(
+            url,
+            headers=self.headers,
+            data=payload,
+            timeout=app.config['CHATWORK_TIMEOUT']
+        )
 
     def post(self, room_id, body):
         '''
+        chatworkに送るメッセージをキューに入れる
+        chatworkは5分で100回のAPI呼び出し制限があるので、ここでは送らない。
+        実際に送るのはNotifier
         @param int room_id
         @param string body
-        @return int 正常に完了すれば200が返る
-        chatworkにメッセージを送る
+        @return int キューに入れたら200を返す
         '''
 
-        r = Connect().open()
-
-        # キューに入っているのがあればまとめてpostする
-        # lrangeは値がなければ空のlistを返す
-        items_len = r.llen(app.config['QUEUE_CHATWORK_MSG'])
-        if items_len >= 1:
-            for i in range(items_len):
-                item = r.lpop(app.config['QUEUE_CHATWORK_MSG'])
-                item = json.loads(item)
-                self._send(item['room_id'], item['body'])
+        Connect().open().rpush(
+            app.config['QUEUE_CHATWORK_MSG'],
+            json.dumps({'room_id': room_id, 'body': body}))
 
-        return self._send(room_id, body)
+        return 200
@@ -0,0 +1,103 @@
+# coding: utf-8
+
+import gzip
+import pickle
+
+from app import app
+from app.ml.artifact import Artifact
+from app.ml.train import Train
+from app.redis.connect import Connect
+
+
+class ConvertModel():
+    '''
+    旧形式のpickle(PICKLE_*)で保存されているモデルを、Artifactの形式(MODEL_*)に変換する
+    Modelは旧形式を読み込まないので、新しいコードでworkerを再起動する前に1度だけ実行する
+    既にMODEL_*がある場合は、Train.runで学習済みのものなので上書きしない
+
+    pickleの読み込みには学習時と同じsklearnが必要なので、requirements.txtを
+    変更する前に実行すること
+    '''
+
+    # PICKLE_{name}_*, MODEL_{name}の name, 確認に使うデータセットのpos, neg
+    MODELS = (
+        ('PJT_MLM', 'DATASETS_PJT_MLM_POS', 'DATASETS_PJT_MLM_NEG'),
+        ('PJT_VL', 'DATASETS_PJT_VL_POS', 'DATASETS_PJT_VL_NEG'),
+        ('MSG_MLM', 'DATASETS_MSG_POS', 'DATASETS_MSG_NEG'),
+    )
+
+    def _load_pickle(self, r, key):
+        '''
+        @param StrictRedis r decode_responses=Falseで開いたもの
+        @param str key
+        @return object | None
+        '''
+        b = r.get(app.config[key])
+        if not b:
+            return None
+
+        return pickle.loads(gzip.decompress(b))
+
+    def _convert(self, name, pos_key, neg_key):
+        '''
+        @param str name e.g. 'PJT_MLM'
+        @param str pos_key
+        @param str neg_key
+        @return bool 変換した場合はTrue
+        '''
+        model_key = app.config['MODEL_{0}'.format(name)]
+        version_key = app.config['MODEL_{0}_VERSION'.format(name)]
+
+        r = Connect(decode_responses=False).open()
+        if r.exists(model_key):
+            app.logger.info('{0} already exists. skipped'.format(model_key))
+            return False
+
+        vect = self._load_pickle(r, 'PICKLE_{0}_TFIDF'.format(name))
+        lsa = self._load_pickle(r, 'PICKLE_{0}_LSA'.format(name))
+        clf = self._load_pickle(r, 'PICKLE_{0}_CLF'.format(name))
+
+        if vect is None or lsa is None or clf is None:
+            app.logger.warning('PICKLE_{0}_* is not found. skipped'.format(name))
+            return False
+
+        artifact = Artifact()
+        fields = artifact.dumps(artifact.build(vect, lsa, clf))
+
+        # Train.runと同じく、データセットでsklearnのスコアと一致するかを確認してから保存する
+        train = Train(model_key=model_key, version_key=version_key)
+        train.set_datasets(
+            pos_key=app.config[pos_key], neg_key=app.config[neg_key])
+        if not train.items['x']:
+            raise Exception('{0} is empty. Cannot check {1}'.format(
+                pos_key, model_key))
+
+        tfidf_transform = vect.transform(train.items['x'])
+        lsa_transform = lsa.transform(tfidf_transform)
+        train._check(fields, tfidf_transform, clf, lsa_transform)
+        train._save(fields)
+
+        app.logger.info('{0} is converted to {1}'.format(
+            'PICKLE_{0}_*'.format(name), model_key))
+
+        return True
+
+    def run(self):
+        '''
+        @return int 変換したモデルの数
+        '''
+        count = 0
+
+        for name, pos_key, neg_key in self.MODELS:
+            try:
+                if self._convert(name, pos_key, neg_key):
+                    count += 1
+            except Exception as e:
+                app.sentry.captureException(str(e))
+                raise Exception(
+                    'Model conversion is failed. name: {0}, reason: {1}'.format(
+                        name, e))
+
+        print('{0} models are converted'.format(count))
+
+        return count
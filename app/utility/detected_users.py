@@ -0,0 +1,75 @@
+# coding: utf-8
+
+import os
+import threading
+import time
+
+from app import app
+from app.redis.connect import Connect
+from app.redis.scripts import Scripts
+from app.utility.bloom import BloomFilter
+
+
+class DetectedUsers():
+    '''
+    spamを送ったuserを1度だけ通知するための、検知済みuserの管理
+    検知済みかの確認と追加を1回の通信でまとめて行うので、検知済みuserが増えても
+    1回あたりの時間は変わらない
+
+    - MSG_DETECTED_USER_TTLが0の場合は、これまで通りMSG_DETECTED_USER_IDのsetに追加する
+    - 0より大きい場合はuserごとのキーをTTL秒で作る。setが増え続けることはない。
+      既にsetに入っているuserは、引き続き検知済みとして扱う
+    - MSG_DETECTED_USER_BLOOMがTrueの場合は、プロセス内のBloom filterで
+      検知済みと分かったuserはRedisに問い合わせない。
+      誤判定の確率はMSG_DETECTED_USER_BLOOM_ERROR。TTLがある場合はTTL秒ごとに作り直す
+    '''
+
+    # key: pid, value: (BloomFilter, 作成した時刻)
+    _blooms = {}
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.ttl = app.config['MSG_DETECTED_USER_TTL']
+
+    def _bloom(self):
+        '''
+        @return BloomFilter | None
+        '''
+        if not app.config['MSG_DETECTED_USER_BLOOM']:
+            return None
+
+        pid = os.getpid()
+        now = time.monotonic()
+
+        with self._lock:
+            bloom = self._blooms.get(pid)
+            if bloom is None or (self.ttl and now - bloom[1] >= self.ttl):
+                bloom = (BloomFilter(
+                    app.config['MSG_DETECTED_USER_BLOOM_CAPACITY'],
+                    app.config['MSG_DETECTED_USER_BLOOM_ERROR']), now)
+                DetectedUsers._blooms = {pid: bloom}
+
+        return bloom[0]
+
+    def add(self, user_id):
+        '''
+        検知済みでなければ検知済みにする
+        @param int user_id
+        @return bool Trueであれば今回初めて検知した(通知する)
+        '''
+        bloom = self._bloom()
+        if bloom is not None and user_id in bloom:
+            return False
+
+        r = Connect().open()
+        added = r.register_script(Scripts.CHECK_AND_ADD)(
+            keys=[
+                app.config['MSG_DETECTED_USER_ID'],
+                app.config['MSG_DETECTED_USER'].format(user_id)
+            ],
+            args=[user_id, self.ttl])
+
+        if bloom is not None:
+            bloom.add(user_id)
+
+        return bool(added)
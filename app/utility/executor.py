@@ -0,0 +1,57 @@
+# coding: utf-8
+
+import os
+
+from app import app
+
+
+class Executor():
+    '''
+    CPUを使う処理(分かち書き、predict)を実行する
+    geventのworkerで起動している場合は、そのまま実行するとその間は他のgreenletに
+    切り替わらず、Redis等の通信を待っているリクエストも止まってしまう。
+    なのでサイズを制限したスレッドプールで実行し、呼び出し元のgreenletだけが待つようにする
+    syncのworkerで起動している場合はそのまま実行する
+
+    スレッドプールで実行する処理の中ではRedis, MySQLへの通信は行わないこと。
+    通信は呼び出し元のgreenletで済ませてから渡す
+    '''
+
+    # key: pid, value: gevent.threadpool.ThreadPool
+    _pools = {}
+
+    @staticmethod
+    def cooperative():
+        '''
+        geventでsocketがpatchされているか
+        @return bool
+        '''
+        try:
+            from gevent import monkey
+        except ImportError:
+            return False
+
+        return monkey.is_module_patched('socket')
+
+    def _pool(self):
+        # forkしたworkerにmasterのスレッドは引き継がれないので、プロセスごとに作る
+        pid = os.getpid()
+        if pid not in self._pools:
+            from gevent.threadpool import ThreadPool
+            Executor._pools = {
+                pid: ThreadPool(app.config['EXECUTOR_POOL_SIZE'])
+            }
+
+        return self._pools[pid]
+
+    def run(self, fn, *args, **kwargs):
+        '''
+        fnを実行して結果を返す
+        スレッドプールが埋まっている場合は空くまで待つ
+        @param callable fn
+        @return fnの返り値
+        '''
+        if not self.cooperative():
+            return fn(*args, **kwargs)
+
+        return self._pool().apply(fn, args, kwargs)
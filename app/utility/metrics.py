@@ -0,0 +1,124 @@
+# coding: utf-8
+
+import os
+import threading
+import time
+
+from app import app
+from app.redis.connect import Connect
+
+
+class Metrics():
+    '''
+    プロセス内で数値を集計し、METRICS_FLUSH_INTERVAL秒に1回だけRedisのhashに加算する
+    リクエストの度にRedisに書き込むとそれ自体がボトルネックになるので、
+    プロセス内で貯めてからまとめて書き込む
+
+    Redisにはhash型で、次のように保存する
+    key: spam:metrics:{name}
+    {
+        'batches': '1523',                  # incr
+        'fill_ratio:count': '1523',         # observe
+        'fill_ratio:sum': '402.1875',
+        ...
+    }
+    '''
+
+    # key: (pid, name), value: {field: float}
+    _values = {}
+    # key: (pid, name), value: 最後にflushした時刻
+    _flushed = {}
+    _lock = threading.Lock()
+
+    def __init__(self, name):
+        '''
+        @param str name 集計対象の名前 e.g. batcher
+        '''
+        self.name = name
+        self.key = app.config['METRICS'].format(name)
+
+    def _local(self):
+        # forkしたworkerにmasterの集計を引き継がないよう、pidごとに分ける
+        local = (os.getpid(), self.name)
+        if local not in self._values:
+            Metrics._values[local] = {}
+            Metrics._flushed[local] = time.monotonic()
+
+        return local
+
+    def incr(self, field, amount=1):
+        '''
+        @param str field
+        @param int|float amount
+        '''
+        with self._lock:
+            local = self._local()
+            values = self._values[local]
+            values[field] = values.get(field, 0) + amount
+
+        self.flush()
+
+    def observe(self, field, value):
+        '''
+        平均を出せるように、件数と合計を加算する
+        @param str field
+        @param int|float value
+        '''
+        with self._lock:
+            local = self._local()
+            values = self._values[local]
+            values[field + ':count'] = values.get(field + ':count', 0) + 1
+            values[field + ':sum'] = values.get(field + ':sum', 0) + value
+
+        self.flush()
+
+    def flush(self, force=False):
+        '''
+        METRICS_FLUSH_INTERVAL秒経っていれば、貯めた値をRedisに加算する
+        Redisに書き込めなかった値は捨てる。集計のためにリクエストを失敗させない
+        @param bool force Trueであれば経過時間にかかわらず書き込む
+        '''
+        now = time.monotonic()
+
+        with self._lock:
+            local = self._local()
+            if not force and \
+                    now - self._flushed[local] < \
+                    app.config['METRICS_FLUSH_INTERVAL']:
+                return
+
+            values = self._values[local]
+            Metrics._values[local] = {}
+            Metrics._flushed[local] = now
+
+        if not values:
+            return
+
+        try:
+            with Connect().open().pipeline(transaction=False) as pipe:
+                for field, value in values.items():
+                    pipe.hincrbyfloat(self.key, field, value)
+                pipe.execute()
+        except Exception as e:
+            app.logger.warning(
+                'Metrics flush is failed. Reason: {0}'.format(e))
+
+    def get(self):
+        '''
+        Redisに保存された値を取得する。observeした値は平均も計算して返す
+        @return dict
+            e.g. {'batches': 1523.0, 'fill_ratio:count': 1523.0,
+                  'fill_ratio:sum': 402.1875, 'fill_ratio:mean': 0.264...}
+        '''
+        values = {
+            field: float(value) for field, value in
+            Connect(role='slave').open().hgetall(self.key).items()
+        }
+
+        for field in list(values):
+            if field.endswith(':count') and values[field]:
+                base = field[:-len(':count')]
+                values[base + ':mean'] = \
+                    values.get(base + ':sum', 0) / values[field]
+
+        return values
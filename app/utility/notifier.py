@@ -0,0 +1,285 @@
+# coding: utf-8
+
+import json
+import signal
+import time
+from collections import OrderedDict
+
+from app import app
+from app.redis.connect import Connect
+from app.redis.scripts import Scripts
+from app.utility.chatwork import Chatwork
+from app.utility.metrics import Metrics
+
+
+class TokenBucket():
+    '''
+    capacity回 / period秒 の呼び出し制限を守るためのトークンバケット
+    chatworkのレスポンスヘッダの残り回数が分かれば、そちらに合わせる
+    '''
+
+    def __init__(self, capacity, period):
+        '''
+        @param int capacity
+        @param int period 秒
+        '''
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        # 残り回数が0になった場合、この時刻(unix time)までは呼び出さない
+        self.blocked_until = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        '''
+        @return int 今呼び出せる回数
+        '''
+        if time.time() < self.blocked_until:
+            return 0
+
+        self._refill()
+        return int(self.tokens)
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def wait(self):
+        '''
+        @return float 次に1回呼び出せるようになるまでの秒数
+        '''
+        blocked = self.blocked_until - time.time()
+        if blocked > 0:
+            return blocked
+
+        self._refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def sync(self, remaining, reset):
+        '''
+        chatworkが返した残り回数に合わせる
+        @param int remaining X-RateLimit-Remaining
+        @param int reset X-RateLimit-Reset 制限がリセットされるunix time
+        '''
+        self._refill()
+        self.tokens = min(self.tokens, remaining)
+        if remaining <= 0 and reset:
+            self.blocked_until = reset
+
+
+class Notifier():
+    '''
+    QUEUE_CHATWORK_MSGに入ったメッセージをchatworkに送り続ける常駐プロセス
+    Chatwork.postはキューに入れるだけなので、検知の処理がchatworkを待つことはない
+
+    chatworkは5分で100回のAPI呼び出し制限があるので、トークンバケットで制限を守る。
+    送るメッセージが残り回数より多い場合は、roomごとに1つのメッセージにまとめて送る
+
+    取り出したメッセージは、送り終わるまでQUEUE_CHATWORK_PROCESSINGに入れておく。
+    プロセスが落ちても、次に起動したときにキューに戻す
+    Notifierは1つだけ起動すること。複数起動すると呼び出し回数を共有できない
+    '''
+
+    def __init__(self):
+        self.queue = app.config['QUEUE_CHATWORK_MSG']
+        self.processing = app.config['QUEUE_CHATWORK_PROCESSING']
+        self.chatwork = Chatwork()
+        self.bucket = TokenBucket(
+            app.config['CHATWORK_RATE_LIMIT'],
+            app.config['CHATWORK_RATE_PERIOD'])
+        self.metrics = Metrics('notifier')
+        self.r = Connect().open()
+        self._take = self.r.register_script(Scripts.TAKE)
+        self._stopped = False
+
+    def stop(self, signum=None, frame=None):
+        app.logger.info('Notifier is stopping')
+        self._stopped = True
+
+    def recover(self):
+        '''
+        前回落ちたときに処理中リストに残ったメッセージをキューの先頭に戻す
+        @return int 戻した件数
+        '''
+        count = 0
+        while self.r.rpoplpush(self.processing, self.queue):
+            count += 1
+
+        if count:
+            app.logger.warning('Notifier recovered {0} messages'.format(count))
+
+        return count
+
+    def _fetch(self):
+        '''
+        処理中リストがNOTIFIER_PENDING_SIZE件になるまでキューから移し、
+        処理中リストの中身を全て返す
+        @return list of str
+        '''
+        room = app.config['NOTIFIER_PENDING_SIZE'] - self.r.llen(self.processing)
+        if room > 0:
+            self._take(keys=[self.queue, self.processing], args=[room])
+
+        return self.r.lrange(self.processing, 0, -1)
+
+    def _digest(self, raws):
+        '''
+        1つのroomに送るメッセージをNOTIFIER_DIGEST_LENGTH文字以内にまとめる
+        @param list of str raws キューに入っていたjson
+        @return list of tuple (str body, list of str raws)
+        '''
+        digests = []
+        bodies = []
+        included = []
+        length = 0
+
+        for raw in raws:
+            body = json.loads(raw)['body']
+            if bodies and length + len(body) > app.config['NOTIFIER_DIGEST_LENGTH']:
+                digests.append((bodies, included))
+                bodies = []
+                included = []
+                length = 0
+            bodies.append(body)
+            included.append(raw)
+            length += len(body) + 1
+
+        if bodies:
+            digests.append((bodies, included))
+
+        return [
+            ('[info][title]{0}件の通知をまとめて送信[/title]{1}[/info]'.format(
+                len(bodies), '\n'.join(bodies)), included)
+            for bodies, included in digests
+        ]
+
+    def _plan(self, pending, available):
+        '''
+        残りの呼び出し回数に合わせて、送るメッセージを決める
+        @param list of str pending
+        @param int available
+        @return list of tuple (int room_id, str body, list of str raws)
+        '''
+        if len(pending) <= available:
+            return [
+                (json.loads(raw)['room_id'], json.loads(raw)['body'], [raw])
+                for raw in pending
+            ]
+
+        # 足りない場合はroomごとにまとめる。古いメッセージのroomから送る
+        rooms = OrderedDict()
+        for raw in pending:
+            rooms.setdefault(json.loads(raw)['room_id'], []).append(raw)
+
+        plan = []
+        for room_id, raws in rooms.items():
+            for body, included in self._digest(raws):
+                plan.append((room_id, body, included))
+
+        return plan[:available]
+
+    def _send(self, room_id, body):
+        '''
+        @return bool 処理中リストから消してよいか
+        '''
+        self.bucket.take()
+
+        try:
+            res = self.chatwork.send(room_id, body)
+        except Exception as e:
+            app.sentry.captureException(str(e))
+            app.logger.error(
+                'Chawtwork send is failed. Reason: {0}'.format(e))
+            return False
+
+        remaining = res.headers.get('X-RateLimit-Remaining')
+        if remaining is not None:
+            self.bucket.sync(
+                int(remaining), int(res.headers.get('X-RateLimit-Reset', 0)))
+
+        if res.status_code == 429:
+            self.bucket.sync(0, int(res.headers.get('X-RateLimit-Reset', 0)))
+            return False
+
+        if res.status_code >= 500:
+            app.logger.error(
+                'Chawtwork send is failed. status: {0}'.format(res.status_code))
+            return False
+
+        if res.status_code >= 400:
+            # 送り直しても成功しないので捨てる
+            app.logger.error(
+                'Chawtwork message is dropped. status: {0} room_id: {1}'.format(
+                    res.status_code, room_id))
+            self.metrics.incr('dropped')
+
+        return True
+
+    def notify(self):
+        '''
+        処理中リストのメッセージを、残りの呼び出し回数の範囲で送る
+        @return int 送ったメッセージ(まとめた場合はまとめる前)の件数
+        '''
+        pending = self._fetch()
+        if not pending:
+            return 0
+
+        available = self.bucket.available()
+        if available < 1:
+            return 0
+
+        count = 0
+        for room_id, body, raws in self._plan(pending, available):
+            # chatworkが返した残り回数で減っている場合がある。残りは次にまとめて送る
+            if self.bucket.available() < 1:
+                break
+            if not self._send(room_id, body):
+                break
+
+            with self.r.pipeline() as pipe:
+                for raw in raws:
+                    pipe.lrem(self.processing, 1, raw)
+                pipe.execute()
+
+            count += len(raws)
+            self.metrics.incr('sent')
+            if len(raws) > 1:
+                self.metrics.incr('digests')
+                self.metrics.incr('merged', len(raws))
+
+        return count
+
+    def run(self):
+        '''
+        SIGTERMを受け取るまで送り続ける
+        '''
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self.recover()
+
+        app.logger.info('Notifier is started')
+
+        while not self._stopped:
+            if self.notify():
+                continue
+
+            if self.r.llen(self.processing):
+                # 送るものはあるが、呼び出し回数が残っていない。待つ間にキューに溜まった分は
+                # 次にまとめて送る
+                time.sleep(min(self.bucket.wait(), 1) or 1)
+            else:
+                self.r.brpoplpush(
+                    self.queue,
+                    self.processing,
+                    timeout=app.config['NOTIFIER_BLOCK_TIMEOUT'])
+
+        self.metrics.flush(force=True)
+
+        app.logger.info('Notifier is stopped')
@@ -0,0 +1,117 @@
+# coding: utf-8
+
+import gc
+import os
+import psutil
+
+from app import app
+from app.ml.model import Model
+from app.ml.predict import Predict
+from app.ml.wakati import Wakati
+from app.mysql.connect import Connect as Mysql_con
+from app.redis.connect import Connect as Redis_con
+
+
+class Prefork():
+    '''
+    gunicornのpreload_app用の処理
+    masterでモデルを1度だけ読み込んでおけば、forkしたworkerはcopy-on-writeで
+    同じメモリを参照するので、workerの数だけモデルを持つ必要がなくなる。
+    guniconf.pyのフックから呼び出す
+    '''
+
+    # warmupでpredictする文字列
+    WARMUP_BODY = 'はじめまして。お仕事のご相談があります。詳細はこちらのURLをご確認ください。'
+
+    # preloadとwarmupで読み込むモデル
+    MODELS = (
+        ('MODEL_MSG_MLM', 'MODEL_MSG_MLM_VERSION'),
+    )
+
+    def memory(self):
+        '''
+        自プロセスのメモリ使用量を返す
+        rssはcopy-on-writeで共有しているページも含むので、workerごとの実際の
+        使用量はuss, 共有分を按分した使用量はpssを見ること
+        @return dict {'rss': int, 'pss': int, 'uss': int} 単位はbyte
+        '''
+        p = psutil.Process(os.getpid())
+
+        try:
+            info = p.memory_full_info()
+        except (psutil.AccessDenied, AttributeError):
+            info = p.memory_info()
+
+        return {
+            'rss': info.rss,
+            'pss': getattr(info, 'pss', None),
+            'uss': getattr(info, 'uss', None),
+        }
+
+    def _log_memory(self, label):
+        mem = self.memory()
+        app.logger.info('{0} pid: {1} rss: {2} pss: {3} uss: {4}'.format(
+            label, os.getpid(), mem['rss'], mem['pss'], mem['uss']))
+
+    def preload(self):
+        '''
+        masterで実行する。モデルとMeCab.Taggerを読み込む
+        workerのメインスレッドはmasterのTaggerをそのまま引き継ぐ
+        '''
+        for model, version in self.MODELS:
+            try:
+                Model(
+                    model=app.config[model],
+                    version=app.config[version]
+                ).get()
+            except Exception as e:
+                # Redisに接続できなくてもworkerは起動させる。各workerが読み込み直す
+                app.logger.warning('Model preload is failed. Reason: {0}'.format(e))
+
+        Wakati().parse(self.WARMUP_BODY)
+
+        # masterで作ったオブジェクトをGCの対象から外す。
+        # GCがオブジェクトのヘッダに書き込むとcopy-on-writeでページがコピーされてしまう
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
+        # masterで開いた接続はworkerに引き継がない
+        Redis_con.reset()
+
+        self._log_memory('Preloaded.')
+
+    def post_fork(self):
+        '''
+        workerで実行する。worker用の接続を開き、warmupのpredictを1回実行する
+        '''
+        Redis_con.reset()
+        self._log_memory('Forked.')
+
+        if not Redis_con(role='master').is_connect():
+            app.logger.warning('Redis master is not connected')
+        if not Redis_con(role='slave').is_connect():
+            app.logger.warning('Redis slave is not connected')
+        if not Redis_con(host='pubsub').is_connect():
+            app.logger.warning('Redis pubsub is not connected')
+
+        for role in ('master', 'slave'):
+            try:
+                con = Mysql_con(role=role)
+                if not con.is_connect():
+                    app.logger.warning('Mysql {0} is not connected'.format(role))
+                con.close()
+            except Exception as e:
+                app.logger.warning('Mysql {0} is not connected. Reason: {1}'.format(
+                    role, e))
+
+        for model, version in self.MODELS:
+            try:
+                Predict(
+                    model=app.config[model],
+                    version=app.config[version]
+                )._predict(Wakati().parse(self.WARMUP_BODY))
+            except Exception as e:
+                app.logger.warning('Warmup is failed. Reason: {0}'.format(e))
+
+        self._log_memory('Warmed up.')
@@ -1,7 +1,13 @@
 # coding: utf-8
 
+import atexit
+import os
+import threading
+from collections import OrderedDict
+
 import msgpack
 
+from app import app
 from app.redis.connect import Connect
 
 
@@ -13,44 +19,117 @@ class Websocket():
     https://github.com/GameXG/socket.io-python-emitter
     ただ、Of, Inがまともに動いておらず、socket.io-redisは言ってしまえばただのredisへの
     publishなので、自分で実装して直接publishする
+
+    emitは1件ずつpublishせず、WEBSOCKET_EMIT_WAIT_MSミリ秒の間に呼び出された分を
+    まとめてpipelineでpublishする。同じboard_id, message_idの更新が複数あれば最後の1件だけ送る
     '''
 
+    # key: pid, value: OrderedDict {(board_id, message_id): (channel_name, bytes)}
+    _pending = {}
+    _lock = threading.Lock()
+
+    # socket.io-redisのイベント名、渡すデータはこのような形である。
+    # ['emitter',
+    #  {'type': 2, 'data': ['spam_update_message', {...}], 'nsp': '/'},
+    #  {'rooms': [board_id], 'flags': []}]
+    # {...}とboard_id以外は毎回同じなので、事前にmsgpackにしておく
+    _packer = msgpack.Packer()
+    _prefix = b''.join([
+        _packer.pack_array_header(3),
+        _packer.pack('emitter'),
+        _packer.pack_map_header(3),
+        # socket.ioはv1からバイナリ形式のデータ、つまり、画像・動画も送信できる
+        # ようになった。文字列型と区別するためにtypeキーがある。
+        # 文字列型は2で、バイナリ型は5を指定する
+        _packer.pack('type'),
+        _packer.pack(2),
+        _packer.pack('data'),
+        _packer.pack_array_header(2),
+        _packer.pack('spam_update_message'),
+    ])
+    _middle = b''.join([
+        # namespaceのこと
+        _packer.pack('nsp'),
+        _packer.pack('/'),
+        _packer.pack_map_header(2),
+        _packer.pack('rooms'),
+        _packer.pack_array_header(1),
+    ])
+    _suffix = b''.join([
+        _packer.pack('flags'),
+        _packer.pack_array_header(0),
+    ])
+
+    def _pack(self, args):
+        '''
+        @param dict args
+        @return bytes msgpack.packbで全体を作った場合と同じ値
+        '''
+        packer = msgpack.Packer()
+
+        return b''.join([
+            self._prefix,
+            packer.pack({
+                'board_id': args['board_id'],
+                'message_id': args['message_id'],
+                'feedback_from_admin': args['feedback_from_admin'],
+                'feedback_from_user': args['feedback_from_user'],
+                'predict': args['predict'],
+            }),
+            self._middle,
+            packer.pack(args['board_id']),
+            self._suffix,
+        ])
+
     def emit_spam_update_message(self, args):
         '''
         spam_update_messageイベントをemitする
+        WEBSOCKET_EMIT_WAIT_MSミリ秒後にまとめてpublishされる
         @param dict args
-        @return int
-            Returns the number of subscribers the message was delivered to.
         '''
 
-        r = Connect(host='pubsub', role='master').open()
-
         channel_name = 'socket.io#/#{0}#'.format(args['board_id'])
+        key = (args['board_id'], args['message_id'])
 
-        # socket.io-redisのイベント名、渡すデータはこのような形である。
-        data_packed = msgpack.packb([
-            'emitter',
-            {
-                # socket.ioはv1からバイナリ形式のデータ、つまり、画像・動画も送信できる
-                # ようになった。文字列型と区別するためにtypeキーがある。
-                # 文字列型は2で、バイナリ型は5を指定する
-                'type': 2,
-                'data': [
-                    'spam_update_message', {
-                        'board_id': args['board_id'],
-                        'message_id': args['message_id'],
-                        'feedback_from_admin': args['feedback_from_admin'],
-                        'feedback_from_user': args['feedback_from_user'],
-                        'predict': args['predict'],
-                    }
-                ],
-                # namespaceのこと
-                'nsp': '/'
-            },
-            {
-                'rooms': [args['board_id']],
-                'flags': []
-            }
-        ])
+        with self._lock:
+            pid = os.getpid()
+            if pid not in self._pending:
+                # forkしたworkerにmasterの分を引き継がないよう、pidごとに分ける
+                Websocket._pending = {pid: OrderedDict()}
+                atexit.register(self.flush)
+
+            pending = self._pending[pid]
+            first = not pending
+            pending[key] = (channel_name, self._pack(args))
+
+        if first:
+            timer = threading.Timer(
+                app.config['WEBSOCKET_EMIT_WAIT_MS'] / 1000, self.flush)
+            timer.daemon = True
+            timer.start()
+
+    def flush(self):
+        '''
+        溜まっている分をまとめてpublishする
+        @return int publishした件数
+        '''
+        with self._lock:
+            pending = self._pending.get(os.getpid())
+            if not pending:
+                return 0
+            items = list(pending.values())
+            pending.clear()
+
+        try:
+            r = Connect(host='pubsub', role='master').open()
+            with r.pipeline(transaction=False) as pipe:
+                for channel_name, data_packed in items:
+                    pipe.publish(channel_name, data_packed)
+                pipe.execute()
+        except Exception as e:
+            app.sentry.captureException(str(e))
+            app.logger.error(
+                'Websocket emit is failed. Reason: {0}'.format(e))
+            return 0
 
-        return r.publish(channel_name, data_packed)
+        return len(items)
@@ -73,6 +73,93 @@ class CommonConfig(object):
     SCORE_THRESHOLD_MSG_SPAM = 2.190
     SCORE_THRESHOLD_MSG_SCRAPE = 0.00
 
+    # プロセス内にキャッシュしたモデルのバージョンを確認する間隔(秒)
+    MODEL_CHECK_INTERVAL = 5
+    # Trueの場合は、lsa >> clfの代わりにfusedの重みベクトルでscoreを出す
+    PREDICT_FUSED = True
+    # Redisから取得したモデルをmmapで読み込むためのローカルのファイルキャッシュ
+    MODEL_CACHE_DIR = 'storage/models'
+
+    # POST /v1/spams:batch で1度に受け付けるitemsの最大数
+    SPAM_BATCH_MAX_SIZE = 1000
+
+    # geventのworkerで、分かち書きとpredictを実行するスレッドの数(1プロセスあたり)
+    EXECUTOR_POOL_SIZE = 4
+
+    # 同時に呼び出されたpredictをまとめる最大件数と、最初の1件から待つ最大時間(ミリ秒)
+    # PREDICT_BATCH_SIZEを1にするとまとめずに実行する
+    PREDICT_BATCH_SIZE = 32
+    PREDICT_BATCH_WAIT_MS = 5
+
+    # predictの結果のキャッシュ。プロセス内のLRUの最大件数と、Redisに保存する秒数
+    PREDICT_CACHE_SIZE = 10000
+    PREDICT_CACHE_TTL = 60 * 60 * 24
+
+    # Consumer: 1回の通信でキューから取り出す最大件数,
+    # キューが空の時に待つ秒数, 処理件数とキューの長さをログに出す間隔(秒)
+    CONSUMER_BATCH_SIZE = 32
+    CONSUMER_BLOCK_TIMEOUT = 1
+    CONSUMER_REPORT_INTERVAL = 60
+
+    # Pipeline: Predict.stages_msgの段階ごとのスレッド数と、段階の間のキューの最大件数
+    # fetch, save: MySQL, predict: 分かち書き・predict(CPU), scrape: HTTP,
+    # notify: Chatwork, Redis
+    # saveはcommitされるまで待つので、まとめて書き込めるように多めにしておく
+    PIPELINE_CONCURRENCY = {
+        'fetch': 4,
+        'predict': 2,
+        'scrape': 8,
+        'save': 16,
+        'notify': 2,
+    }
+    PIPELINE_QUEUE_SIZE = 64
+
+    # message_spamsにまとめて書き込む最大件数と、最初の1件から待つ最大時間(ミリ秒)
+    MESSAGE_SPAMS_WRITE_SIZE = 100
+    MESSAGE_SPAMS_WRITE_WAIT_MS = 50
+
+    # Chatwork: APIの呼び出し制限(CHATWORK_RATE_PERIOD秒でCHATWORK_RATE_LIMIT回)と
+    # タイムアウト(秒)
+    CHATWORK_RATE_LIMIT = 100
+    CHATWORK_RATE_PERIOD = 300
+    CHATWORK_TIMEOUT = 10
+
+    # Notifier: 処理中リストに入れておく最大件数, まとめて送る場合の1メッセージの最大文字数,
+    # キューが空の時に待つ秒数
+    NOTIFIER_PENDING_SIZE = 1000
+    NOTIFIER_DIGEST_LENGTH = 10000
+    NOTIFIER_BLOCK_TIMEOUT = 5
+
+    # 検知済みuser: 0より大きければuserごとにその秒数だけ検知済みにする。0であれば期限なし
+    MSG_DETECTED_USER_TTL = 0
+    # Trueであれば、検知済みuserをプロセス内のBloom filterでも判定する
+    MSG_DETECTED_USER_BLOOM = False
+    MSG_DETECTED_USER_BLOOM_CAPACITY = 100000
+    MSG_DETECTED_USER_BLOOM_ERROR = 0.0001
+
+    # websocketへのemitをまとめてpublishするまで待つ時間(ミリ秒)
+    WEBSOCKET_EMIT_WAIT_MS = 20
+
+    # Metricsをプロセス内で貯めてからRedisに書き込む間隔(秒)
+    METRICS_FLUSH_INTERVAL = 10
+
+    # Overlap: この割合(difflib.SequenceMatcher.ratio)より似ていれば重複とする
+    OVERLAP_THRESHOLD = 0.9
+    # Overlapで重複の候補を探すMinHash/LSH。shingleの文字数, bandの数, 1bandあたりの行数
+    # BANDSを増やす・ROWSを減らすと取りこぼしが減り、比較する候補が増える
+    OVERLAP_SHINGLE_SIZE = 5
+    OVERLAP_LSH_BANDS = 32
+    OVERLAP_LSH_ROWS = 4
+
+    # Wakati.parse_many: 1度にworkerへ渡す件数と、同時に読み込んでおくchunkの数(1workerあたり)
+    PARSE_MANY_CHUNK_SIZE = 100
+    PARSE_MANY_PREFETCH = 4
+
+    # Update.run: MySQLからfetchmanyで1度に読み込み、分かち書きと重複チェックをする件数
+    UPDATE_FETCH_SIZE = 1000
+    # fetchmanyで少しずつ読み込む間、MySQLが送信を待つ秒数(net_write_timeout)
+    MYSQL_NET_WRITE_TIMEOUT = 600
+
     cpu_count = os.cpu_count()
     if ENVIRONMENT == 'development':
         POOL_PROCESS_NUM = os.cpu_count()
@@ -86,7 +173,11 @@ class CommonConfig(object):
 
     PJT_LAST_PULLED = 'spam:pjt:last_pulled'
     MSG_LAST_PULLED = 'spam:msg:last_pulled'
+    # Update.runで最後に読み込んだid。{0}部分にはobj_typeを入れる
+    UPDATE_LAST_ID = 'spam:update:last_id:{0}'
 
+    # 旧形式のgzip済みpickle。ConvertModelでMODEL_*に変換するためだけに残している
+    # 変換が済んだ環境では参照されない
     PICKLE_PJT_MLM_TFIDF = 'spam:pickle:pjt:mlm:tfidf'
     PICKLE_PJT_MLM_LSA = 'spam:pickle:pjt:mlm:lsa'
     PICKLE_PJT_MLM_CLF = 'spam:pickle:pjt:mlm:clf'
@@ -99,11 +190,20 @@ class CommonConfig(object):
     PICKLE_MSG_MLM_LSA = 'spam:pickle:msg:mlm:lsa'
     PICKLE_MSG_MLM_CLF = 'spam:pickle:msg:mlm:clf'
 
+    # Train.runが学習の度にincrする。Modelはこの値が変わったらモデルを読み込み直す
+    MODEL_PJT_MLM_VERSION = 'spam:model:pjt:mlm:version'
+    MODEL_PJT_VL_VERSION = 'spam:model:pjt:vl:version'
+    MODEL_MSG_MLM_VERSION = 'spam:model:msg:mlm:version'
+
     # Type: List
     QUEUE_BASE_PJT = 'spam:queue:base:pjt'
     QUEUE_BASE_MSG = 'spam:queue:base:msg'
     QUEUE_CHATWORK_PJT = 'spam:queue:chatwork:pjt'
     QUEUE_CHATWORK_MSG = 'spam:queue:chatwork:msg'
+    # Consumerが処理中のmessage_id。{0}部分にはConsumerの名前を入れる
+    QUEUE_PROCESSING_MSG = 'spam:queue:processing:msg:{0}'
+    # Notifierが送信中のchatworkのメッセージ
+    QUEUE_CHATWORK_PROCESSING = 'spam:queue:processing:chatwork:msg'
 
     # Type: hash
     DATASETS_PJT_MLM_POS = 'spam:ds:pjt:mlm:pos'
@@ -115,6 +215,12 @@ class CommonConfig(object):
     DATASETS_MSG_POS = 'spam:ds:msg:pos'
     DATASETS_MSG_NEG = 'spam:ds:msg:neg'
 
+    # DATASETS_*のLSHIndex。{0}部分にはDATASETS_*のキーを入れる
+    # Type: set {1}: bandの番号, {2}: bucket
+    DATASETS_LSH = '{0}:lsh:{1}:{2}'
+    # Type: hash key: id, value: bucket
+    DATASETS_LSH_BUCKETS = '{0}:lsh:buckets'
+
     # 一時保存場所 Noun: 名詞
     # Type: hash
     DATASETS_TMP_PJT_POS = 'spam:ds:tmp:pjt:mlm:pos'
@@ -122,6 +228,12 @@ class CommonConfig(object):
     DATASETS_TMP_MSG_POS = 'spam:ds:tmp:msg:pos'
     DATASETS_TMP_MSG_NEG = 'spam:ds:tmp:msg:neg'
 
+    # 学習済みモデル。Artifactの形式で配列を保存する
+    # Type: hash
+    MODEL_PJT_MLM = 'spam:model:pjt:mlm'
+    MODEL_PJT_VL = 'spam:model:pjt:vl'
+    MODEL_MSG_MLM = 'spam:model:msg:mlm'
+
     # {0}部分には日時を入れる
     REPORT_PJT_PATH = 'storage/reports/{0}_report_pjt.csv'
     REPORT_MSG_PATH = 'storage/reports/{0}_report_msg.csv'
@@ -132,6 +244,18 @@ class CommonConfig(object):
     MSG_DETECTED_USER_ID = 'spam:msg:detected:user:id'
     URL_BLACKLIST = 'spam:url:blacklist'
 
+    # Type: string
+    # MSG_DETECTED_USER_TTLが0より大きい場合の検知済みuser。{0}部分にはuser_idを入れる
+    MSG_DETECTED_USER = 'spam:msg:detected:user:{0}'
+
+    # Type: string
+    # {0}: モデルのキー, {1}: モデルのchecksum, {2}: 正規化した本文のsha1
+    PREDICT_CACHE = 'spam:predict:cache:{0}:{1}:{2}'
+
+    # Type: hash
+    # {0}部分にはMetricsの名前を入れる
+    METRICS = 'spam:metrics:{0}'
+
 
 class Whitelists(object):
     '''
@@ -1,19 +1,41 @@
+import os
 import multiprocessing
 
+from dotenv import load_dotenv
+
 '''
 Config file for gunicorn
 
 Start command
 gunicorn run:app -c guniconf.py -D
+
+GUNICORN_WORKER_CLASS=gevent を.envに設定すると協調的なworkerで起動する
+Redis, MySQL, Chatworkへの通信を待っている間は他のリクエストを処理するので、
+workerの数を増やさなくても同時に多くのリクエストを捌ける
 '''
 
+load_dotenv('.env')
+
+# 'sync' or 'gevent'
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+
+if 'gevent' in worker_class:
+    # preload_appでappを読み込む前にpatchしておかないと、
+    # masterで読み込んだモジュールがpatch前のsocketを参照してしまう
+    from gevent import monkey
+    monkey.patch_all()
+
 # Server Socket
 bind = 'unix:/var/run/gunicorn/gunicorn_spam.sock'
 backlog = 2048
 
+# Server Mechanics
+# masterでappを読み込んでからforkするので、モデルはworker間でcopy-on-writeで共有される
+preload_app = True
+
 # Worker Processes
 workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = 'sync'
+# gevent workerの1プロセスあたりの最大同時接続数
 worker_connections = 1000
 max_requests = 0
 timeout = 30
@@ -29,3 +51,20 @@ logconfig = None
 
 # Process Name
 proc_name = 'spam_api'
+
+
+# Server Hooks
+def when_ready(server):
+    '''
+    masterでworkerをforkする前に1度だけ呼ばれる
+    '''
+    from app.utility.prefork import Prefork
+    Prefork().preload()
+
+
+def post_fork(server, worker):
+    '''
+    fork直後のworkerで呼ばれる
+    '''
+    from app.utility.prefork import Prefork
+    Prefork().post_fork()
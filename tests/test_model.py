@@ -0,0 +1,75 @@
+# coding: utf-8
+
+import random
+import unittest
+
+import numpy as np
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import PassiveAggressiveClassifier
+
+from app.ml.artifact import Artifact
+from app.ml.model import Bundle
+from app.ml.train import Train
+
+
+class BundleTest(unittest.TestCase):
+    '''
+    Artifactから組み立てたBundleのTF-IDF値とscore(fused, lsa >> clfの両方)が、
+    sklearnと一致することを確認する。Train._checkが学習時に行う確認と同じもの
+    '''
+
+    def setUp(self):
+        rand = random.Random(0)
+        words = ['w{0}'.format(i) for i in range(200)]
+
+        # 前半の単語をspam、後半の単語をspamではない文書にする
+        self.x = []
+        self.y = []
+        for i in range(200):
+            base = words[:100] if i % 2 else words[100:]
+            self.x.append(' '.join(rand.choice(base) for _ in range(30)))
+            self.y.append(i % 2)
+
+        self.vect = TfidfVectorizer(analyzer='word', ngram_range=(1, 1))
+        self.tfidf = self.vect.fit_transform(self.x)
+        self.lsa = TruncatedSVD(n_components=16, random_state=0)
+        self.lsa_transform = self.lsa.fit_transform(self.tfidf)
+        self.clf = PassiveAggressiveClassifier(C=0.1, random_state=0)
+        self.clf.fit(self.lsa_transform, self.y)
+
+        artifact = Artifact()
+        self.fields = artifact.dumps(
+            artifact.build(self.vect, self.lsa, self.clf))
+        manifest, arrays = artifact.loads(self.fields)
+        self.bundle = Bundle(None, manifest, arrays)
+
+    def test_transform(self):
+        tfidf = self.bundle.transform(self.x)
+
+        np.testing.assert_allclose(
+            tfidf.toarray(), self.tfidf.toarray(), rtol=1e-4, atol=1e-4)
+
+    def test_decision_function(self):
+        tfidf = self.bundle.transform(self.x)
+        score = self.clf.decision_function(self.lsa_transform)
+
+        for fused in [True, False]:
+            np.testing.assert_allclose(
+                self.bundle.decision_function(tfidf, fused=fused), score,
+                rtol=1e-4, atol=1e-4)
+
+        np.testing.assert_array_equal(
+            self.bundle.predict(self.bundle.decision_function(tfidf)),
+            self.clf.predict(self.lsa_transform))
+
+    def test_train_check(self):
+        train = Train()
+        train.items = {'x': self.x, 'y': self.y}
+
+        # 一致しなければ例外になる
+        train._check(self.fields, self.tfidf, self.clf, self.lsa_transform)
+
+
+if __name__ == '__main__':
+    unittest.main()
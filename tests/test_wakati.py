@@ -0,0 +1,110 @@
+# coding: utf-8
+
+import json
+import os
+import random
+import re
+import threading
+import unittest
+
+# configはappを読み込むので、appを先に読み込んでおかないと循環importになる
+from app import app
+from app.ml.wakati import Wakati
+from config import Words
+
+
+class RemoveWordsTest(unittest.TestCase):
+    '''
+    Wakati.remove_remove_wordsが、REMOVE_WORDSを先頭から順にre.subした場合と
+    同じ結果になることを確認する
+    '''
+
+    def sequential(self, s):
+        for word in Words.REMOVE_WORDS:
+            s = re.sub(word, '', s)
+        return s
+
+    def test_overlapping_words(self):
+        wakati = Wakati()
+
+        for s in ['書き手の設定なし', '（？…）', '(なし)', '商標登録予定なし',
+                  'Lancersサポートチーム：', '===Lancersサポートチーム===',
+                  'よろしくお願いいたしますよろしくお願い致します', ' \n　']:
+            self.assertEqual(
+                wakati.remove_remove_words(s), self.sequential(s), s)
+
+    def test_corpus(self):
+        '''
+        REMOVE_WORDSとその一部をつなげた文書、20,000件で比較する
+        '''
+        words = [w.replace('\\', '') for w in Words.REMOVE_WORDS]
+        fragments = words + [w[:k] for w in words for k in (1, 2, 3)] + \
+            [w[-k:] for w in words for k in (1, 2)] + \
+            ['（', '）', '(', ')', '?', '!', ' ', '\n', 'あ', '案件']
+
+        rand = random.Random(0)
+        wakati = Wakati()
+
+        for _ in range(20000):
+            s = ''.join(
+                rand.choice(fragments) for _ in range(rand.randint(1, 30)))
+            self.assertEqual(
+                wakati.remove_remove_words(s), self.sequential(s), s)
+
+
+class NormalizeTest(unittest.TestCase):
+    '''
+    Wakati.normalizeの結果が、precompileする前の実装と同じであることを確認する
+    data/normalize.jsonは、precompileする前の実装で作った[入力, 期待する出力]のlist
+    '''
+
+    def test_golden(self):
+        path = os.path.join(
+            os.path.dirname(__file__), 'data', 'normalize.json')
+        with open(path, encoding='utf-8') as f:
+            cases = json.load(f)
+
+        wakati = Wakati()
+        for doc, expected in cases:
+            self.assertEqual(wakati.normalize(doc), expected, doc)
+
+
+
+@unittest.skipUnless(
+    os.path.isdir(app.config['NEOLOGD_PATH']), 'NEOLOGD_PATH is not found')
+class TokensTest(unittest.TestCase):
+    '''
+    Wakati.tokensの結果を確認する
+    mecab-python3の0.7系では、Taggerを作った直後のparseToNodeでnode.surfaceが
+    壊れることがあるので、新しいスレッド(新しいTagger)で実行する
+    '''
+
+    DOC = 'Pythonで在宅のデータ分析の案件を募集しています'
+
+    def tokens_in_new_thread(self, doc):
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(Wakati().tokens(doc)))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_tokens(self):
+        tokens = self.tokens_in_new_thread(self.DOC)
+        normalized = Wakati().normalize(self.DOC)
+
+        # 未知語は表層形になる。辞書によってはPythonは未知語
+        self.assertIn('Python', tokens)
+        self.assertIn('案件', tokens)
+        for token in tokens:
+            self.assertTrue(token)
+            self.assertIn(token, normalized)
+
+    def test_parse(self):
+        self.assertEqual(
+            Wakati().parse(self.DOC),
+            ' '.join(self.tokens_in_new_thread(self.DOC)))
+
+
+if __name__ == '__main__':
+    unittest.main()